@@ -0,0 +1,178 @@
+#  Copyright 2016 Amazon Web Services, Inc. or its affiliates. All Rights Reserved.
+#  This file is licensed to you under the AWS Customer Agreement (the "License").
+#  You may not use this file except in compliance with the License.
+#  A copy of the License is located at http://aws.amazon.com/agreement/ .
+#  This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied.
+#  See the License for the specific language governing permissions and limitations under the License.
+
+# Sends the result of a custom resource to CloudFormation.
+#
+# Each macro is packaged from its own lambda directory, so the same copy of this
+# file is included in every macro that needs it. Keep the copies identical.
+# It has no dependencies beyond the standard library and runs on Python 2.7 and 3.
+#
+# If the response can't be delivered the stack waits for up to an hour, so the
+# connection to the response URL is kept open between invocations, every request
+# has a timeout, and failed requests are retried with backoff while there is time.
+
+import json
+import random
+import socket
+import time
+
+try:
+    from http.client import HTTPConnection, HTTPException, HTTPSConnection
+    from urllib.parse import urlsplit
+except ImportError:
+    from httplib import HTTPConnection, HTTPException, HTTPSConnection
+    from urlparse import urlsplit
+
+SUCCESS = "SUCCESS"
+FAILED = "FAILED"
+
+# CloudFormation rejects responses larger than this
+MAX_RESPONSE_BYTES = 4096
+
+# Seconds to wait to connect to, or for a response from, the response URL
+TIMEOUT = 10
+
+# How many times to try to send a response, and the backoff between attempts
+MAX_ATTEMPTS = 5
+BASE_DELAY = 0.5
+MAX_DELAY = 8
+
+# Seconds to leave at the end of an invocation rather than start another attempt
+TIME_MARGIN = 1
+
+# Open connections, by scheme and host, reused by warm invocations
+connections = {}
+
+
+def connection(scheme, netloc, timeout):
+    key = (scheme, netloc)
+
+    if key not in connections:
+        connection_class = HTTPSConnection if scheme == "https" else HTTPConnection
+        connections[key] = connection_class(netloc, timeout=timeout)
+
+    connections[key].timeout = timeout
+
+    return connections[key]
+
+
+def close_connection(scheme, netloc):
+    existing = connections.pop((scheme, netloc), None)
+
+    if existing is not None:
+        existing.close()
+
+
+def remaining_seconds(context):
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+
+    return context.get_remaining_time_in_millis() / 1000.0 - TIME_MARGIN
+
+
+def fit_response(responseBody):
+    """
+    Returns the JSON for a response, shortened to fit within MAX_RESPONSE_BYTES.
+    The Reason is truncated first. If the Data is still too large the
+    response is sent as FAILED without it, rather than being rejected.
+    """
+
+    body = json.dumps(responseBody).encode("utf-8")
+
+    if len(body) <= MAX_RESPONSE_BYTES:
+        return body
+
+    reason = responseBody["Reason"]
+
+    while len(body) > MAX_RESPONSE_BYTES and reason:
+        reason = reason[:max(len(reason) - (len(body) - MAX_RESPONSE_BYTES) - 3, 0)]
+        body = json.dumps(dict(responseBody, Reason=reason + "...")).encode("utf-8")
+
+    if len(body) <= MAX_RESPONSE_BYTES:
+        return body
+
+    print("Response is {} bytes, too large to send with its data".format(len(body)))
+
+    responseBody = dict(
+        responseBody,
+        Status=FAILED,
+        Reason="Response data is too large to send to CloudFormation ({} bytes)".format(len(body)),
+        Data={},
+    )
+
+    return json.dumps(responseBody).encode("utf-8")
+
+
+def put(responseUrl, body, context=None):
+    """
+    PUT the body to the response URL, retrying connection errors, throttling
+    and server errors. Returns True if it was accepted.
+    """
+
+    url = urlsplit(responseUrl)
+    path = url.path + ("?" + url.query if url.query else "")
+    headers = {
+        "content-type": "",
+        "content-length": str(len(body)),
+    }
+
+    for attempt in range(MAX_ATTEMPTS):
+        remaining = remaining_seconds(context)
+        timeout = TIMEOUT if remaining is None else max(min(TIMEOUT, remaining), 1)
+
+        try:
+            conn = connection(url.scheme, url.netloc, timeout)
+            conn.request("PUT", path, body=body, headers=headers)
+            response = conn.getresponse()
+            # Read the whole response so the connection can be reused
+            response.read()
+
+            print("Status code: {} {}".format(response.status, response.reason))
+
+            if response.status < 300:
+                return True
+
+            if response.status != 429 and response.status < 500:
+                return False
+        except (HTTPException, socket.error) as e:
+            print("Sending the response failed: {}".format(e))
+            close_connection(url.scheme, url.netloc)
+
+        # Exponential backoff with full jitter, as long as there's time for another attempt
+        delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+        remaining = remaining_seconds(context)
+
+        if attempt + 1 == MAX_ATTEMPTS or (remaining is not None and remaining < delay + 1):
+            break
+
+        time.sleep(delay)
+
+    return False
+
+
+def send(event, context, responseStatus, responseData, physicalResourceId=None, noEcho=False, reason=None):
+    responseUrl = event['ResponseURL']
+
+    responseBody = {}
+    responseBody['Status'] = responseStatus
+    responseBody['Reason'] = reason or 'See the details in CloudWatch Log Stream: ' + context.log_stream_name
+    responseBody['PhysicalResourceId'] = physicalResourceId or context.log_stream_name
+    responseBody['StackId'] = event['StackId']
+    responseBody['RequestId'] = event['RequestId']
+    responseBody['LogicalResourceId'] = event['LogicalResourceId']
+    responseBody['NoEcho'] = noEcho
+    responseBody['Data'] = responseData
+
+    body = fit_response(responseBody)
+
+    print("Response body:\n" + body.decode("utf-8"))
+
+    if not put(responseUrl, body, context):
+        print("Unable to send the response to CloudFormation")
+        return False
+
+    return True
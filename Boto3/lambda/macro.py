@@ -17,8 +17,21 @@ PREFIX = "Boto3::"
 
 LAMBDA_ARN = os.environ["LAMBDA_ARN"]
 
+# The resource type that makes a list of calls
+ACTIONS = PREFIX + "Actions"
+
+def check_actions(actions):
+    # Each item is a call or a chain of calls made in order
+    for item in actions:
+        for call in item if isinstance(item, list) else [item]:
+            if not isinstance(call, dict) or "Action" not in call:
+                raise Exception("Every call in Actions needs an Action")
+
 def handle_template(request_id, template):
     for name, resource in template.get("Resources", {}).items():
+        if resource["Type"] == ACTIONS and isinstance(resource.get("Properties", {}).get("Actions"), list):
+            check_actions(resource["Properties"]["Actions"])
+
         if resource["Type"].startswith(PREFIX):
             resource.update({
                 "Type": "Custom::Boto3",
@@ -38,15 +51,19 @@ def handle_template(request_id, template):
 
 def handler(event, context):
     fragment = event["fragment"]
-    status = "success"
 
     try:
         fragment = handle_template(event["requestId"], event["fragment"])
     except Exception as e:
-        status = "failure"
+        return {
+            "requestId": event["requestId"],
+            "status": "failure",
+            "fragment": fragment,
+            "errorMessage": str(e),
+        }
 
     return {
         "requestId": event["requestId"],
-        "status": status,
+        "status": "success",
         "fragment": fragment,
     }
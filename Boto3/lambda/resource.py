@@ -11,48 +11,59 @@
 # ANY KIND, either express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
 
-from urllib2 import build_opener, HTTPHandler, Request
 import base64
 import boto3
-import httplib
+import cfnresponse
 import json
+import os
+import threading
 
-def sendResponse(event, context, status, message):
-    body = json.dumps({
-        "Status": status,
-        "Reason": message,
-        "StackId": event['StackId'],
-        "RequestId": event['RequestId'],
-        "LogicalResourceId": event['LogicalResourceId'],
-        "PhysicalResourceId": event["ResourceProperties"]["Action"],
-        "Data": {},
-    })
-
-    request = Request(event['ResponseURL'], data=body)
-    request.add_header('Content-Type', '')
-    request.add_header('Content-Length', len(body))
-    request.get_method = lambda: 'PUT'
-
-    opener = build_opener(HTTPHandler)
-    response = opener.open(request)
-
-def execute(action, properties):
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
+# The Action of a resource that makes a list of calls
+ACTIONS = "Actions"
+
+# The most chains of calls run at once in Actions mode
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", 8))
+
+# Clients by (service, region). Creating a client loads its service model from disk,
+# so they are kept for warm invocations. Clients are safe to share between threads
+# but creating them isn't, hence the lock.
+clients = {}
+clients_lock = threading.Lock()
+
+def sendResponse(event, context, status, message, data=None):
+    cfnresponse.send(event, context, status, data or {}, event["ResourceProperties"]["Action"], reason=message)
+
+def get_client(service, region=None):
+    key = (service, region)
+
+    with clients_lock:
+        if key not in clients:
+            clients[key] = boto3.client(service, region_name=region)
+
+    return clients[key]
+
+def execute(action, properties, region=None):
     action = action.split(".")
 
     if len(action) != 2:
-        return "FAILED", "Invalid boto3 call: {}".format(".".join(action))
+        return "FAILED", "Invalid boto3 call: {}".format(".".join(action)), None
 
     client, function = action[0], action[1]
 
     try:
-        client = boto3.client(client.lower())
+        client = get_client(client.lower(), region)
     except Exception as e:
-        return "FAILED", "boto3 error: {}".format(e)
+        return "FAILED", "boto3 error: {}".format(e), None
 
     try:
         function = getattr(client, function)
     except Exception as e:
-        return "FAILED", "boto3 error: {}".format(e)
+        return "FAILED", "boto3 error: {}".format(e), None
 
     properties = {
         key[0].lower() + key[1:]: value
@@ -60,11 +71,93 @@ def execute(action, properties):
     }
 
     try:
-        function(**properties)
+        response = function(**properties)
     except Exception as e:
-        return "FAILED", "boto3 error: {}".format(e)
+        return "FAILED", "boto3 error: {}".format(e), None
+
+    return "SUCCESS", "Completed successfully", response
+
+def flatten(prefix, value, data):
+    # Nested values are returned as Name.Key.0.Key so that they can be used with Fn::GetAtt
+    if isinstance(value, dict):
+        for key, item in value.items():
+            flatten("{}.{}".format(prefix, key), item, data)
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            flatten("{}.{}".format(prefix, index), item, data)
+    else:
+        data[prefix] = value
+
+def result_data(name, response):
+    # Dates, streams and other values that aren't JSON are returned as strings
+    response = json.loads(json.dumps(response or {}, default=str))
+    response.pop("ResponseMetadata", None)
+
+    data = {}
+    flatten(name, response, data)
+
+    return data
+
+def run_chain(chain):
+    # Calls in a chain are made in order, and the chain stops at the first one that fails
+    data = {}
+
+    for call in chain:
+        name = call.get("Name", call["Action"])
+        status, message, response = execute(call["Action"], call.get("Properties", {}), call.get("Region"))
 
-    return "SUCCESS", "Completed successfully"
+        if status != "SUCCESS":
+            return status, "{}: {}".format(name, message), data
+
+        if "Name" in call:
+            data.update(result_data(call["Name"], response))
+
+    return "SUCCESS", "Completed {} calls".format(len(chain)), data
+
+def execute_actions(actions):
+    # Each item of actions is a call or a list of calls. The lists are chains of
+    # calls that depend on each other, the items are independent and run at once.
+    chains = [item if isinstance(item, list) else [item] for item in actions]
+    results = [None] * len(chains)
+    pending = Queue()
+
+    for index, chain in enumerate(chains):
+        pending.put((index, chain))
+
+    def worker():
+        while True:
+            try:
+                index, chain = pending.get_nowait()
+            except Empty:
+                return
+
+            # A malformed call (e.g. Properties that aren't a map) must fail its chain rather
+            # than the thread, or no response would be sent
+            try:
+                results[index] = run_chain(chain)
+            except Exception as e:
+                name = chain[0].get("Name", chain[0].get("Action", index)) if chain and isinstance(chain[0], dict) else index
+                results[index] = ("FAILED", "{}: {}".format(name, e), {})
+
+    threads = [threading.Thread(target=worker) for _ in range(min(MAX_CONCURRENCY, len(chains)))]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    data = {}
+
+    for status, message, chain_data in results:
+        data.update(chain_data)
+
+    failures = [message for status, message, chain_data in results if status != "SUCCESS"]
+
+    if failures:
+        return "FAILED", "; ".join(failures), data
+
+    return "SUCCESS", "Completed {} calls".format(sum(len(chain) for chain in chains)), data
 
 def handler(event, context):
     print("Received request:", json.dumps(event, indent=4))
@@ -79,7 +172,11 @@ def handler(event, context):
     mode = properties["Mode"]
 
     if request == mode or request in mode:
-        status, message = execute(properties["Action"], properties["Properties"])
+        if properties["Action"] == ACTIONS:
+            status, message, data = execute_actions(properties["Properties"].get("Actions", []))
+            return sendResponse(event, context, status, message, data)
+
+        status, message, _ = execute(properties["Action"], properties["Properties"])
         return sendResponse(event, context, status, message)
 
     return sendResponse(event, context, "SUCCESS", "No action taken")
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Benchmark of process_template on synthetic templates.
+
+Compares the copy-on-write transform with the copy.deepcopy of the whole
+template it replaced, with and without a resource to multiply:
+
+    python bench.py
+"""
+
+import copy
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+
+import index
+
+SIZES = [1000, 5000, 20000]
+
+def synthetic_template(resources, counted):
+    template = {'Resources': {}}
+    for i in range(resources):
+        template['Resources']['Queue{}'.format(i)] = {
+            'Type': 'AWS::SQS::Queue',
+            'Properties': {
+                'QueueName': 'queue-{}'.format(i),
+                'Tags': [{'Key': 'tag{}'.format(j), 'Value': 'v' * 40} for j in range(5)],
+            },
+        }
+    if counted:
+        template['Resources']['Counted'] = {
+            'Type': 'AWS::SQS::Queue',
+            'Count': 10,
+            'Properties': {'QueueName': 'counted-%d'},
+        }
+    return template
+
+def best(function, repeat=5):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+def main():
+    logging.getLogger().setLevel(logging.WARNING)
+    index.MAX_FRAGMENT_BYTES = sys.maxsize
+    print('{:>9}  {:>5}  {:>9}  {:>13}'.format('resources', 'Count', 'deepcopy', 'copy-on-write'))
+    for resources in SIZES:
+        for counted in (False, True):
+            template = synthetic_template(resources, counted)
+            deepcopied = best(lambda: index.process_template(copy.deepcopy(template)))
+            copyonwrite = best(lambda: index.process_template(template))
+            print('{:>9}  {:>5}  {:>8.3f}s  {:>12.3f}s'.format(resources, 'yes' if counted else 'no', deepcopied, copyonwrite))
+
+if __name__ == '__main__':
+    main()
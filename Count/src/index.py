@@ -1,59 +1,255 @@
-import copy
+import ast
 import json
+import logging
+import os
+import re
+import sys
 
-def process_template(template):
-    new_template = copy.deepcopy(template)
+# The largest response fragment, in bytes, the macro will produce before failing
+MAX_FRAGMENT_BYTES = int(os.environ.get('MAX_FRAGMENT_BYTES', 1024 * 1024))
+
+# Set LOG_LEVEL to DEBUG to log every copy that is made, not just one summary line per resource
+logger = logging.getLogger()
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+class FragmentTooLargeError(Exception):
+    pass
+
+class InvalidCountError(Exception):
+    pass
+
+def process_template(template, parameters=None):
+    #Copy-on-write: only the Resources map is rebuilt, resources without a Count are passed through by reference
+    #and the input template is never modified, so it can be returned as-is if processing fails
+    new_template = dict(template)
+    new_template['Resources'] = dict(template['Resources'])
     status = 'success'
+    #Keep a running total of the serialized size of the output fragment, once there is something to multiply
+    fragmentSize = None
 
     for name, resource in template['Resources'].items():
         if 'Count' in resource:
-            #Get the number of times to multiply the resource
-            count = new_template['Resources'][name].pop('Count')
-            print("Found 'Count' property with value {} in '{}' resource....multiplying!".format(count,name))            
-            #Remove the original resource from the template but take a local copy of it
-            resourceToMultiply = new_template['Resources'].pop(name)
-            #Create a new block of the resource multiplied with names ending in the iterator and the placeholders substituted
-            resourcesAfterMultiplication = multiply(name, resourceToMultiply, count)
-            if not set(resourcesAfterMultiplication.keys()) & set(new_template['Resources'].keys()):
-                new_template['Resources'].update(resourcesAfterMultiplication)
-            else:
-                status = 'failed'
-                return status, template
+            if fragmentSize is None:
+                fragmentSize = len(json.dumps(template))
+            #Get the number of times to multiply the resource, or the list of values to multiply it over
+            count = resolve_count(name, resource['Count'], template, parameters or {})
+            #Remove the original resource from the template but take a local copy of it without the Count
+            new_template['Resources'].pop(name)
+            resourceToMultiply = {key: value for key, value in resource.items() if key != 'Count'}
+            fragmentSize -= len(json.dumps({name: resource}))
+            resourceSize = 0
+            #Write each copy straight into the output resources as it is generated
+            for newName, newResource, copySize in multiply(name, resourceToMultiply, count):
+                if newName in new_template['Resources']:
+                    logger.info(json.dumps({'resource': name, 'status': 'failed', 'collision': newName}))
+                    status = 'failed'
+                    return status, template
+                resourceSize += copySize
+                if fragmentSize + resourceSize > MAX_FRAGMENT_BYTES:
+                    raise FragmentTooLargeError(
+                        "Multiplying '{}' exceeds the fragment size budget of {} bytes at copy '{}'".format(
+                            name, MAX_FRAGMENT_BYTES, newName))
+                new_template['Resources'][newName] = newResource
+            fragmentSize += resourceSize
+            #One summary line per multiplied resource
+            logger.info(json.dumps({
+                'resource': name,
+                'count': len(count) if isinstance(count, list) else count,
+                'bytes': resourceSize,
+                'fragmentBytes': fragmentSize,
+            }))
         else:
-            print("Did not find 'Count' property in '{}' resource....Nothing to do!".format(name))
+            logger.debug("Did not find 'Count' property in '%s' resource....Nothing to do!", name)
     return status, new_template
 
-def update_placeholder(resource_structure, iteration):
-    #Convert the json into a string
-    resourceString = json.dumps(resource_structure)
-    #Count the number of times the placeholder is found in the string
-    placeHolderCount = resourceString.count('%d')
-
-    #If the placeholder is found then replace it
-    if placeHolderCount > 0:
-        print("Found {} occurrences of decimal placeholder in JSON, replacing with iterator value {}".format(placeHolderCount, iteration))
-        #Make a list of the values that we will use to replace the decimal placeholders - the values will all be the same
-        placeHolderReplacementValues = [iteration] * placeHolderCount
-        #Replace the decimal placeholders using the list - the syntax below expands the list
-        resourceString = resourceString % (*placeHolderReplacementValues,)
-        #Convert the string back to json and return it
-        return json.loads(resourceString)
-    else:
-        print("No occurences of decimal placeholder found in JSON, therefore nothing will be replaced")
-        return resource_structure
+# Arithmetic allowed in a Count expression
+EXPRESSION_OPERATORS = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: lambda a, b: a * b,
+    ast.FloorDiv: lambda a, b: a // b,
+    ast.Mod: lambda a, b: a % b,
+}
+
+# Python 3.6 and 3.7 parse numbers as ast.Num, later versions as ast.Constant
+NUMBER_NODES = (ast.Constant, ast.Num) if sys.version_info < (3, 8) else (ast.Constant,)
+
+def resolve_count(resource_name, count, template, parameters):
+    """
+    Resolve a Count property to either an integer or a list of values.
+
+    Count may be an integer, a {"Ref": ...} to a template parameter, a list of
+    values or an arithmetic expression string such as "Shards * 2" that may
+    refer to template parameters by name.
+    """
+    if isinstance(count, dict) and list(count.keys()) == ['Ref']:
+        count = resolve_parameter(resource_name, count['Ref'], template, parameters)
+    if isinstance(count, list):
+        return count
+    if isinstance(count, bool):
+        raise InvalidCountError("Invalid Count in '{}': {}".format(resource_name, count))
+    if isinstance(count, str):
+        try:
+            count = evaluate(ast.parse(count.strip(), mode='eval').body, resource_name, template, parameters)
+        except (SyntaxError, ZeroDivisionError) as e:
+            raise InvalidCountError("Invalid Count expression in '{}': {}".format(resource_name, e))
+    if not isinstance(count, int) or count < 0:
+        raise InvalidCountError("Invalid Count in '{}': {}".format(resource_name, count))
+    return count
+
+def resolve_parameter(resource_name, parameter, template, parameters):
+    if parameter not in parameters:
+        raise InvalidCountError("Count in '{}' refers to unknown parameter '{}'".format(resource_name, parameter))
+    value = parameters[parameter]
+    parameterType = template.get('Parameters', {}).get(parameter, {}).get('Type', '')
+    if isinstance(value, str) and (parameterType == 'CommaDelimitedList' or parameterType.startswith('List<')):
+        return [item.strip() for item in value.split(',')]
+    return value
+
+def evaluate(node, resource_name, template, parameters):
+    if isinstance(node, NUMBER_NODES):
+        value = node.value if isinstance(node, ast.Constant) else node.n
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+    if isinstance(node, ast.Name):
+        value = resolve_parameter(resource_name, node.id, template, parameters)
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise InvalidCountError("Parameter '{}' used in the Count of '{}' is not an integer".format(node.id, resource_name))
+    if isinstance(node, ast.BinOp) and type(node.op) in EXPRESSION_OPERATORS:
+        return EXPRESSION_OPERATORS[type(node.op)](
+            evaluate(node.left, resource_name, template, parameters),
+            evaluate(node.right, resource_name, template, parameters))
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return -evaluate(node.operand, resource_name, template, parameters)
+    raise InvalidCountError("Unsupported Count expression in '{}'".format(resource_name))
+
+# The placeholders that are substituted in every copy:
+#   %d   - the iterator value, counting from 1
+#   %i   - the iterator value, counting from 0
+#   %03d - the iterator value zero-padded to the given width (also works with %i)
+#   %s   - the value from the list when Count is a list
+PLACEHOLDER_RE = re.compile(r'(%(?:0\d+)?[di]|%s)')
+
+def placeholder_values(tokens, iteration, values=None):
+    """Returns the string each placeholder token is replaced with for the given iteration"""
+    substitutions = {}
+    for token in tokens:
+        if token == '%s':
+            if values is not None:
+                substitutions[token] = str(values[iteration - 1])
+        else:
+            index = iteration if token[-1] == 'd' else iteration - 1
+            substitutions[token] = str(index).zfill(int(token[1:-1] or 0))
+    return substitutions
+
+def compile_placeholders(structure, tokens=None):
+    """
+    Walk a resource once and record where the placeholders are.
+
+    Returns None if the structure contains no placeholders, otherwise a plan
+    describing only the parts that change between copies:
+      ('str', parts)   - a string split on the placeholders, which are at the odd indices
+      ('dict', plans)  - {key: (key plan, value plan)} for the changing entries
+      ('list', plans)  - {index: plan} for the changing items
+    If a dict is passed as tokens, it is updated with the number of times each placeholder occurs.
+    """
+    if isinstance(structure, str):
+        parts = PLACEHOLDER_RE.split(structure)
+        if len(parts) == 1:
+            return None
+        if tokens is not None:
+            for token in parts[1::2]:
+                tokens[token] = tokens.get(token, 0) + 1
+        return ('str', parts)
+    if isinstance(structure, dict):
+        plans = {}
+        for key, value in structure.items():
+            keyPlan = compile_placeholders(key, tokens)
+            valuePlan = compile_placeholders(value, tokens)
+            if keyPlan is not None or valuePlan is not None:
+                plans[key] = (keyPlan, valuePlan)
+        return ('dict', plans) if plans else None
+    if isinstance(structure, list):
+        plans = {}
+        for index, item in enumerate(structure):
+            itemPlan = compile_placeholders(item, tokens)
+            if itemPlan is not None:
+                plans[index] = itemPlan
+        return ('list', plans) if plans else None
+    return None
+
+def instantiate(structure, plan, substitutions):
+    """
+    Build one copy of a compiled structure using the given placeholder substitutions.
+    Only the paths recorded in the plan are rebuilt, everything else is shared
+    with the original structure.
+    """
+    if plan is None:
+        return structure
+    kind, data = plan
+    if kind == 'str':
+        return ''.join([
+            substitutions.get(part, part) if index % 2 else part
+            for index, part in enumerate(data)
+        ])
+    if kind == 'dict':
+        newStructure = {}
+        for key, value in structure.items():
+            if key in data:
+                keyPlan, valuePlan = data[key]
+                key = instantiate(key, keyPlan, substitutions)
+                value = instantiate(value, valuePlan, substitutions)
+            newStructure[key] = value
+        return newStructure
+    return [
+        instantiate(item, data.get(index), substitutions)
+        for index, item in enumerate(structure)
+    ]
 
 def multiply(resource_name, resource_structure, count):
-    resources = {}
+    """
+    Yields (name, resource, serialized size) for each copy of the resource, one
+    at a time, so that the copies never all sit in memory at once.
+    count is either the number of copies or a list of values to substitute for %s.
+    """
+    values = count if isinstance(count, list) else None
+    if values is not None:
+        count = len(values)
+    #Walk the resource once to find the placeholders, rather than once per copy
+    tokens = {}
+    plan = compile_placeholders(resource_structure, tokens)
+    #The serialized size of a copy only differs from the original by the width of the substituted values
+    #Account for the resource name and the separators around it as well
+    baseSize = len(json.dumps(resource_structure)) + len(json.dumps(resource_name)) + len(': , ')
+    debug = logger.isEnabledFor(logging.DEBUG)
     #Loop according to the number of times we want to multiply, creating a new resource each time
     for iteration in range(1, (count + 1)):
-        print("Multiplying '{}', iteration count {}".format(resource_name,iteration))        
-        multipliedResourceStructure = update_placeholder(resource_structure,iteration)
-        resources[resource_name+str(iteration)] = multipliedResourceStructure
-    return resources
+        substitutions = placeholder_values(tokens, iteration, values)
+        multipliedResourceStructure = instantiate(resource_structure, plan, substitutions)
+        suffix = str(iteration)
+        resourceSize = baseSize + len(suffix) + sum(
+            occurrences * (len(json.dumps(substitutions[token])) - 2 - len(token))
+            for token, occurrences in tokens.items()
+            if token in substitutions
+        )
+        if debug:
+            logger.debug("Multiplying '%s', iteration count %d: %s", resource_name, iteration, json.dumps(substitutions))
+        yield resource_name + suffix, multipliedResourceStructure, resourceSize
 
 
 def handler(event, context):
-    result = process_template(event['fragment'])
+    try:
+        result = process_template(event['fragment'], event.get('templateParameterValues'))
+    except (FragmentTooLargeError, InvalidCountError) as e:
+        logger.error(str(e))
+        return {
+            'requestId': event['requestId'],
+            'status': 'failed',
+            'fragment': event['fragment'],
+            'errorMessage': str(e),
+        }
     return {
         'requestId': event['requestId'],
         'status': result[0],
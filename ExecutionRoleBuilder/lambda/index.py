@@ -12,59 +12,163 @@
 # ANY KIND, either express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
 
+import fnmatch
+import hashlib
 import json
-import uuid
+import logging
+import os
+import re
 from policytemplates import *
+from templateregistry import PolicyTemplateRegistry, backendforsource
+
+# Set LOG_LEVEL to DEBUG to log the fragments and every permission as they are expanded
+logger = logging.getLogger()
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
 
 # Variable for the default role path, if a role path is not provided
 defaultrolepath = '/boundedexecutionroles/'
 
-# Core function handler
+# IAM limits the combined size of a role's inline policies (excluding whitespace)
+maxinlinepolicybytes = 10240
+
+# Statement keys that can safely be merged with other statements for the same Effect and Resource
+mergeablekeys = set(['Effect', 'Action', 'Resource'])
+
+# Substitution tokens used in the templates in policytemplates.py
+tokenpattern = re.compile(r'<(RESOURCE|UUID|ROLENAME|ROLETYPE)>')
+
+try:
+    stringtypes = basestring
+except NameError:
+    stringtypes = str
+
+# Function to find the substitution slots in a parsed template, so that rendering it
+# only needs to rebuild the parts that contain them. Returns None if there are none.
+def findslots(value):
+    if isinstance(value, stringtypes):
+        parts = tokenpattern.split(value)
+        return ('str', parts) if len(parts) > 1 else None
+    if isinstance(value, dict):
+        slots = dict((key, findslots(item)) for key, item in value.items())
+        slots = dict((key, slot) for key, slot in slots.items() if slot is not None)
+        return ('dict', slots) if slots else None
+    if isinstance(value, list):
+        slots = dict((index, findslots(item)) for index, item in enumerate(value))
+        slots = dict((index, slot) for index, slot in slots.items() if slot is not None)
+        return ('list', slots) if slots else None
+    return None
+
+# Function to fill in the slots of a parsed template, sharing everything else with the template
+def fillslots(value, slots, values):
+    if slots is None:
+        return value
+    kind, data = slots
+    if kind == 'str':
+        # Tokens are at the odd indices of the split string
+        parts = [values[part] if index % 2 else part for index, part in enumerate(data)]
+        if all(isinstance(part, stringtypes) for part in parts):
+            return ''.join(parts)
+        # A token was filled with an intrinsic function (e.g. Fn::GetAtt) so it can't be joined
+        # until the stack is deployed. A string that is just the token becomes the function itself.
+        parts = [part for part in parts if part != '']
+        if len(parts) == 1:
+            return parts[0]
+        return {'Fn::Join': ['', parts]}
+    # Only the entries containing slots are rebuilt, the rest are shared
+    filled = value.copy() if kind == 'dict' else list(value)
+    for key, slot in data.items():
+        filled[key] = fillslots(value[key], slot, values)
+    return filled
+
+# Parse a template once, along with its substitution slots. Templates from policytemplates.py
+# are strings, templates from the template library have already been parsed.
+def compiletemplate(template):
+    parsed = json.loads(template) if isinstance(template, stringtypes) else template
+    return parsed, findslots(parsed)
+
+# Render a compiled template with the given token values (e.g. {'RESOURCE': ...})
+def rendertemplate(compiled, values):
+    parsed, slots = compiled
+    return fillslots(parsed, slots, values)
+
+# The role template from policytemplates.py, parsed once when the function is loaded
+compiledroletemplate = compiletemplate(roletemplate)
+
+# The policy templates, indexed by service and action group. The built-in templates from
+# policytemplates.py are extended by the template library in POLICY_TEMPLATE_SOURCE, which
+# is either a directory or an S3 URL (s3://bucket/prefix), and defaults to the templates
+# directory bundled with the function. The library is checked for changes at most once
+# every POLICY_TEMPLATE_TTL seconds.
+registry = PolicyTemplateRegistry(
+    backendforsource(os.environ.get('POLICY_TEMPLATE_SOURCE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))),
+    compiletemplate,
+    builtins=policytemplates,
+    ttl=int(os.environ.get('POLICY_TEMPLATE_TTL', 300)),
+)
+
+# Core function handler. Errors such as an unusable resource in a permission are
+# returned to CloudFormation, so that they are shown instead of a generic failure.
 def handler(event, context):
+    try:
+        fragment = convert_template(event["fragment"])
+    except Exception as e:
+        logger.error(str(e))
+        return {
+            "requestId": event["requestId"],
+            "status": "failure",
+            "fragment": event["fragment"],
+            "errorMessage": str(e),
+        }
     return {
         "requestId": event["requestId"],
         "status": "success",
-        "fragment": convert_template(event["fragment"]),
-}
+        "fragment": fragment,
+    }
 
 # Function to convert/expand the template
 def convert_template(fragment):
-    # Debug output
-    print ('This was the fragment: {}'.format(fragment))
+    # Debug output, the fragment is only serialized when it will be logged
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug('This was the fragment: %s', json.dumps(fragment))
     
     # Loop through each resource in the template
     resources = fragment['Resources']
+    # Index the resource types once, so that references to other resources in the
+    # permissions (e.g. Fn::GetAtt) can be resolved to the service they belong to
+    resourcetypes = resourcetypeindex(fragment)
     for resource in resources:
-        print ('Determining if {} is an IAM role'.format(resource))
+        logger.debug('Determining if %s is an IAM role', resource)
         resourcejson = resources[resource]
         # If the resource is an IAM Role, expand the shorthand notation to the proper
         # CloudFormation using the function below, otherwise leave the resource as is
         if resourcejson['Type'] == 'AWS::IAM::Role':
-            print ('Found a role: {}'.format(resource))
+            logger.debug('Found a role: %s', resource)
             # Expanding role
-            resources[resource] = expand_role(resourcejson)
+            resources[resource] = expand_role(resourcejson, resourcetypes)
     
     # Debug output
-    print ('This is the transformed fragment: {}'.format(fragment))
+    if debug:
+        logger.debug('This is the transformed fragment: %s', json.dumps(fragment))
     # Return the converted/expanded template fragment
     return fragment
 
 # Function to expand shorthand role definitions into proper CloudFormation
-def expand_role(rolefragment):
+def expand_role(rolefragment, resourcetypes=None):
     # Debug output
-    print ('This is the role fragment: {}'.format(rolefragment))
+    logger.debug('This is the role fragment: %s', rolefragment)
     
     # Extract shorthand properties for role type, name, and desired permissions
     roletype = rolefragment['Properties']['Type']
     rolename = rolefragment['Properties']['Name']
     permissions = rolefragment['Properties']['Permissions']
  
-    # Get the basic role template (from policytemplates.py) and do a simple string
-    # replace to set the name and the AWS service principal for the trust policy (e.g. lambda)
-    returnval = roletemplate.replace('<ROLETYPE>',roletype.lower())
-    returnval = returnval.replace('<ROLENAME>',rolename)
-    # Load this as json to form the initial basis of the function return value
-    returnvaljson = json.loads(returnval)
+    # Render the basic role template (from policytemplates.py) to set the name and the
+    # AWS service principal for the trust policy (e.g. lambda), forming the initial
+    # basis of the function return value
+    returnvaljson = rendertemplate(compiledroletemplate, {'ROLETYPE': roletype.lower(), 'ROLENAME': rolename})
+    # The properties are added to below, so they must not be shared with the template
+    returnvaljson = dict(returnvaljson, Properties=dict(returnvaljson['Properties'], Policies=[]))
 
     # If the shorthand notation included a list of managed policy ARNs pass those though as-is
     if 'ManagedPolicyArns' in rolefragment['Properties']:
@@ -84,43 +188,208 @@ def expand_role(rolefragment):
     # Loop through each of the short hand permissions
     for permission in permissions:
         # Debug output
-        print ('permission: {}'.format(permission))
+        logger.debug('permission: %s', permission)
         # Split each shorthand permission into an action group (e.g. ReadOnly) and the associated Resource
         for actiongroup,resource in permission.items():
-            print ('actiongroup: {}, resource: {}'.format(actiongroup,resource))
+            logger.debug('actiongroup: %s, resource: %s', actiongroup, resource)
             # Use the function below to extract the service (e.g. S3) from the resource ARN
-            service = servicefromresource(resource)
-            print ('service: {}'.format(service))
-            # Lookup the given policy snippet from policytemplates.py based on the service & action group
-            # If the necessary snippet isn't included in policytemplates.py err out
-            if service in policytemplates and actiongroup in policytemplates[service]:
-                policytemplate = policytemplates[service][actiongroup]
-            else:
+            service = servicefromresource(resource, resourcetypes)
+            logger.debug('service: %s', service)
+            # Lookup the given policy snippet from the registry based on the service & action group
+            # If there is no snippet for them err out
+            policytemplate = registry.lookup(service, actiongroup)
+            if policytemplate is None:
                 # TODO: Better error handling
                 raise Exception('No policy template found for service: {} and actiongroup: {}'.format(service,actiongroup))
-            # Substitute the placeholder in the template for the actual resource 
-            policytemplate = policytemplate.replace('<RESOURCE>',resource)
-            # Policy names must be unique, appending a UUID is a simple way to guarantee that
-            uuidval = str(uuid.uuid4())
-            policytemplate = policytemplate.replace('<UUID>', uuidval)
-            # Convert the policy snippet to json and add it as an inline policy to the overall return values
-            policytemplatejson = json.loads(policytemplate)
-            print ('adding policy: {}'.format(policytemplate))
-            returnvaljson['Properties']['Policies'].append(policytemplatejson)
+            # Substitute the placeholder in the template for the actual resource
+            policytemplatejson = namepolicy(rendertemplate(policytemplate, {'RESOURCE': resource, 'UUID': '<UUID>'}))
+            addpolicy(returnvaljson, policytemplatejson)
       
     # In addition to the permissions in the shorthand notation add the 'allroles' policy template
     # This template is used to provide permissions like CloudWatchLogs instead of forcing each
     # developer to repeatedly specify common permissions
-    uuidval = str(uuid.uuid4())
-    allrolespolicytemplate = policytemplates['allroles']['default']
-    allrolespolicytemplate = allrolespolicytemplate.replace('<UUID>', uuidval)
-    allrolespolicytemplatejson = json.loads(allrolespolicytemplate)
-    print ('adding policy: {}'.format(allrolespolicytemplate))
-    returnvaljson['Properties']['Policies'].append(allrolespolicytemplatejson)
+    allrolespolicytemplatejson = namepolicy(rendertemplate(registry.lookup('allroles', 'default'), {'UUID': '<UUID>'}))
+    addpolicy(returnvaljson, allrolespolicytemplatejson)
+
+    # Unless asked not to, merge the policies into one to keep the role document small
+    if rolefragment['Properties'].get('ConsolidatePolicies', True) not in (False, 'false', 'False'):
+        returnvaljson['Properties']['Policies'] = [consolidatepolicies(returnvaljson['Properties']['Policies'])]
+
+    # Report the size of the inline policies and fail early if IAM would reject them
+    policybytes = sum(len(minifiedjson(policy['PolicyDocument'])) for policy in returnvaljson['Properties']['Policies'])
+    logger.info('role %s: %d inline policies, %d bytes', rolename, len(returnvaljson['Properties']['Policies']), policybytes)
+    if policybytes > maxinlinepolicybytes:
+        raise Exception('Inline policies for role {} are {} bytes, over the IAM limit of {} bytes'.format(rolename, policybytes, maxinlinepolicybytes))
   
     # Return the expanded proper CloudFormation 
     return returnvaljson
   
-# Simple function to return the AWS service (e.g. S3) from a given resource ARN 
-def servicefromresource(resource):
-    return resource.split(':')[2]
+# Function to produce the most compact JSON for a value, as IAM counts its size
+def minifiedjson(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+# Policy names must be unique within a role, and stable between deployments so that
+# unchanged policies aren't updated. The <UUID> token is replaced with a hash of the content.
+def namepolicy(policy):
+    contenthash = hashlib.sha256(minifiedjson(policy['PolicyDocument']).encode('utf-8')).hexdigest()[:16]
+    return dict(policy, PolicyName=policy['PolicyName'].replace('<UUID>', contenthash))
+
+# Function to add a policy to a role, skipping it if an identical one was already added
+def addpolicy(rolejson, policy):
+    policies = rolejson['Properties']['Policies']
+    if any(existing['PolicyName'] == policy['PolicyName'] for existing in policies):
+        logger.debug('skipping duplicate policy: %s', policy['PolicyName'])
+        return
+    logger.debug('adding policy: %s', policy['PolicyName'])
+    policies.append(policy)
+
+# Function to return a value that may be a single item or a list as a list
+def aslist(value):
+    return value if isinstance(value, list) else [value]
+
+# Function to drop duplicate actions, and actions already covered by a wildcard action
+def dedupeactions(actions):
+    unique = sorted(set(actions), key=lambda action: action.lower())
+    wildcards = [action for action in unique if '*' in action]
+    return [
+        action for action in unique
+        if not any(wildcard != action and fnmatch.fnmatch(action.lower(), wildcard.lower()) for wildcard in wildcards)
+    ]
+
+# Function to merge statements with the same Effect and Resource, and dedupe their actions
+def consolidatestatements(statements):
+    merged = []
+    mergedbykey = {}
+    for statement in statements:
+        # Statements with conditions, principals, NotAction etc. are kept as they are
+        if set(statement) != mergeablekeys:
+            merged.append(statement)
+            continue
+        resources = sorted(set(minifiedjson(resource) for resource in aslist(statement['Resource'])))
+        key = (statement['Effect'], tuple(resources))
+        if key in mergedbykey:
+            mergedbykey[key]['Action'].extend(aslist(statement['Action']))
+        else:
+            mergedbykey[key] = {
+                'Effect': statement['Effect'],
+                'Action': list(aslist(statement['Action'])),
+                'Resource': statement['Resource'],
+            }
+            merged.append(mergedbykey[key])
+    for statement in mergedbykey.values():
+        statement['Action'] = dedupeactions(statement['Action'])
+    return merged
+
+# Function to combine a role's policies into a single policy with consolidated statements
+def consolidatepolicies(policies):
+    statements = []
+    for policy in policies:
+        statements.extend(aslist(policy['PolicyDocument']['Statement']))
+    return namepolicy({
+        'PolicyName': 'Consolidated-<UUID>',
+        'PolicyDocument': {
+            'Version': '2012-10-17',
+            'Statement': consolidatestatements(statements),
+        },
+    })
+
+# Names used for a service in resource types (e.g. AWS::Elasticsearch::Domain) or ARNs that
+# differ from the name used for its policy templates and IAM actions
+servicealiases = {
+    'apigatewayv2': 'apigateway',
+    'elasticloadbalancingv2': 'elasticloadbalancing',
+    'elasticsearch': 'es',
+    'kinesisfirehose': 'firehose',
+    'opensearchservice': 'es',
+    'stepfunctions': 'states',
+}
+
+# Resource types whose Ref is their ARN. Ref returns a name, URL or ID for most types
+# (e.g. the name of an S3 bucket or DynamoDB table), which can't be used in a policy.
+arnreftypes = set([
+    'AWS::Batch::ComputeEnvironment',
+    'AWS::Batch::JobDefinition',
+    'AWS::Batch::JobQueue',
+    'AWS::CertificateManager::Certificate',
+    'AWS::ECS::TaskDefinition',
+    'AWS::ElasticLoadBalancingV2::Listener',
+    'AWS::ElasticLoadBalancingV2::LoadBalancer',
+    'AWS::ElasticLoadBalancingV2::TargetGroup',
+    'AWS::IAM::ManagedPolicy',
+    'AWS::SNS::Topic',
+    'AWS::SecretsManager::Secret',
+    'AWS::StepFunctions::Activity',
+    'AWS::StepFunctions::StateMachine',
+])
+
+# Fn::Sub strings that start with a reference to another resource in the template
+subreferencepattern = re.compile(r'^\$\{([^}!][^}]*)\}')
+
+substitutionpattern = re.compile(r'\$\{[^}]*\}')
+
+# Function to build the index of logical ID to resource type for the resources in a template
+def resourcetypeindex(fragment):
+    return dict(
+        (logicalid, resourcejson.get('Type'))
+        for logicalid, resourcejson in fragment.get('Resources', {}).items()
+    )
+
+# Function to return the name of a service as used for policy templates
+def canonicalservice(service):
+    service = service.lower()
+    return servicealiases.get(service, service)
+
+# Function to return the service for a logical ID (e.g. MyBucket or MyBucket.Arn) in the template
+def servicefromlogicalid(reference, resourcetypes):
+    logicalid = reference.split('.')[0]
+    resourcetype = (resourcetypes or {}).get(logicalid)
+    if resourcetype is None:
+        raise Exception('Cannot determine the service for {}: no resource named {} in the template'.format(reference, logicalid))
+    parts = resourcetype.split('::')
+    if len(parts) != 3 or parts[0] != 'AWS':
+        raise Exception('Cannot determine the service for {} of type {}'.format(reference, resourcetype))
+    return canonicalservice(parts[1])
+
+# Function to return the service for a Ref to a logical ID, which must be to a resource whose Ref is an ARN
+def servicefromref(logicalid, resourcetypes):
+    resourcetype = (resourcetypes or {}).get(logicalid)
+    if resourcetype is not None and resourcetype not in arnreftypes:
+        raise Exception('Ref to {} does not return the ARN of the {}, use Fn::GetAtt {}.Arn instead'.format(logicalid, resourcetype, logicalid))
+    return servicefromlogicalid(logicalid, resourcetypes)
+
+# Function to return the service from an ARN, which may be partly made up of ${} substitutions
+def servicefromarn(arn, resourcetypes):
+    # A Fn::Sub string may start with a reference to another resource (e.g. ${MyBucket.Arn}/*)
+    match = subreferencepattern.match(arn)
+    if match and not match.group(1).startswith('AWS::'):
+        # ${MyResource} without an attribute is the same as a Ref
+        if '.' not in match.group(1):
+            return servicefromref(match.group(1), resourcetypes)
+        return servicefromlogicalid(match.group(1), resourcetypes)
+    # Substitutions (e.g. ${AWS::Partition}) may contain colons, so mask them before splitting
+    parts = substitutionpattern.sub('${}', arn).split(':', 3)
+    if len(parts) < 4 or parts[0] != 'arn' or not parts[2] or '${' in parts[2]:
+        raise Exception('Cannot determine the service from resource: {}'.format(arn))
+    return canonicalservice(parts[2])
+
+# Function to return the AWS service (e.g. S3) from a given resource, which is either an ARN
+# or an intrinsic function (Ref, Fn::GetAtt, Fn::Sub or Fn::Join) that resolves to one
+def servicefromresource(resource, resourcetypes=None):
+    if isinstance(resource, stringtypes):
+        return servicefromarn(resource, resourcetypes)
+    if isinstance(resource, dict) and len(resource) == 1:
+        function, argument = list(resource.items())[0]
+        if function == 'Ref' and isinstance(argument, stringtypes):
+            return servicefromref(argument, resourcetypes)
+        if function == 'Fn::GetAtt':
+            return servicefromlogicalid(argument if isinstance(argument, stringtypes) else argument[0], resourcetypes)
+        if function == 'Fn::Sub':
+            return servicefromarn(argument if isinstance(argument, stringtypes) else argument[0], resourcetypes)
+        if function == 'Fn::Join' and isinstance(argument, list) and len(argument) == 2:
+            delimiter, parts = argument
+            # A join that starts with another resource (e.g. its Arn) belongs to the same service
+            if parts and not isinstance(parts[0], stringtypes):
+                return servicefromresource(parts[0], resourcetypes)
+            # Otherwise only the literal parts are known, and the service must be among them
+            return servicefromarn(delimiter.join(part if isinstance(part, stringtypes) else '${}' for part in parts), resourcetypes)
+    raise Exception('Cannot determine the service from resource: {}'.format(json.dumps(resource)))
@@ -220,9 +220,10 @@ all_roles_template = '''
 }
 '''
 
-# TODO: Add policy snippets for other services (e.g. SNS, SQS, etc) and other
-# action groups (e.g. ReadOnly, ReadWrite, FullAccess) using the samples above 
-# as a reference
+# Policy snippets for other services (e.g. SNS, SQS, etc) and other action groups
+# (e.g. ReadOnly, ReadWrite, FullAccess) can be added to the template library as
+# templates/<service>/<actiongroup>.json, using the samples above as a reference.
+# See templateregistry.py
 
 # Simple data structure to hold all of the policy templates for easier lookup/reference
 policytemplates = {}
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+# Command line tool to check the roles the macro will build before they are deployed.
+# The roles in every template that uses the ExecutionRoleBuilder transform are expanded
+# with convert_template, and the effective permissions of each role are printed as a
+# matrix of (effect, action, resource). The matrix can be saved as a baseline and later
+# runs compared against it, so that CI can report any change in permissions.
+#
+#   python rolematrix.py templates/ --write-baseline roles.json
+#   python rolematrix.py templates/ --baseline roles.json
+
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import index
+
+# The transform name that marks a template as using this macro
+transformname = 'ExecutionRoleBuilder'
+
+# File extensions recognised as templates
+templateextensions = ('.json', '.yaml', '.yml', '.template')
+
+# Function to build a YAML loader for CloudFormation's short-form tags, using libyaml if it is available.
+# Every tag other than !Ref and !Condition is the intrinsic function of the same name (e.g. !GetAtt is Fn::GetAtt).
+def cfnyamlloader():
+    import yaml
+
+    class CloudFormationLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+        pass
+
+    def constructintrinsic(loader, tagsuffix, node):
+        function = tagsuffix if tagsuffix in ('Ref', 'Condition') else 'Fn::' + tagsuffix
+        if isinstance(node, yaml.ScalarNode):
+            value = loader.construct_scalar(node)
+            if function == 'Fn::GetAtt':
+                value = value.split('.', 1)
+        elif isinstance(node, yaml.SequenceNode):
+            value = loader.construct_sequence(node, deep=True)
+        else:
+            value = loader.construct_mapping(node, deep=True)
+        return {function: value}
+
+    CloudFormationLoader.add_multi_constructor('!', constructintrinsic)
+    return CloudFormationLoader
+
+yamlloader = None
+
+# Function to load a JSON or YAML template
+def loadtemplate(filename):
+    global yamlloader
+    with open(filename) as templatefile:
+        text = templatefile.read()
+    if text.lstrip().startswith('{'):
+        return json.loads(text)
+    if yamlloader is None:
+        yamlloader = cfnyamlloader()
+    import yaml
+    return yaml.load(text, Loader=yamlloader)
+
+# Function to expand files, directories and globs into a list of template files
+def findtemplates(paths):
+    templates = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                templates.extend(os.path.join(root, filename) for filename in sorted(files) if filename.endswith(templateextensions))
+        else:
+            templates.extend(sorted(glob.glob(path, recursive=True)) or [path])
+    return templates
+
+# Function to check if a template uses the macro
+def usestransform(template):
+    transform = template.get('Transform', [])
+    return transformname in (transform if isinstance(transform, list) else [transform])
+
+# Function to flatten the inline policies of a role into sorted [effect, action, resource] rows.
+# Intrinsic resources are shown as their minified JSON.
+def rolematrix(rolejson):
+    rows = set()
+    for policy in rolejson['Properties'].get('Policies', []):
+        for statement in index.aslist(policy['PolicyDocument']['Statement']):
+            for action in index.aslist(statement.get('Action', [])):
+                for resource in index.aslist(statement.get('Resource', [])):
+                    resource = resource if isinstance(resource, index.stringtypes) else index.minifiedjson(resource)
+                    rows.add((statement['Effect'], action, resource))
+    return [list(row) for row in sorted(rows)]
+
+# Function to return the rows every role is granted by the 'allroles' policy template
+def allrolesmatrix():
+    policy = index.namepolicy(index.rendertemplate(index.registry.lookup('allroles', 'default'), {'UUID': '<UUID>'}))
+    return set(tuple(row) for row in rolematrix({'Properties': {'Policies': [policy]}}))
+
+allroles = None
+
+# Function to check if a row of the matrix grants a wildcard action or resource.
+# The rows from the 'allroles' policy template are in every role, so they aren't counted.
+def iswildcard(row):
+    global allroles
+    if allroles is None:
+        allroles = allrolesmatrix()
+    effect, action, resource = row
+    if tuple(row) in allroles:
+        return False
+    return effect == 'Allow' and ('*' in action or resource == '*' or resource.endswith(':*'))
+
+# Function to expand the roles in one template, run in a worker process.
+# Returns (filename, {role: matrix}, error, elapsed seconds)
+def expandfile(filename):
+    started = time.time()
+    try:
+        template = loadtemplate(filename)
+        if not isinstance(template, dict) or not usestransform(template):
+            return filename, {}, None, time.time() - started
+        roles = [
+            logicalid for logicalid, resourcejson in template.get('Resources', {}).items()
+            if resourcejson.get('Type') == 'AWS::IAM::Role'
+        ]
+        expanded = index.convert_template(template)
+        matrices = dict(
+            ('{}:{}'.format(filename, logicalid), rolematrix(expanded['Resources'][logicalid]))
+            for logicalid in roles
+        )
+        return filename, matrices, None, time.time() - started
+    except Exception as e:
+        return filename, {}, str(e), time.time() - started
+
+# Function to expand the roles across many templates in parallel.
+# Returns ({role: matrix}, {filename: error}, seconds spent expanding)
+def expandall(filenames, jobs=None):
+    matrices = {}
+    errors = {}
+    busytime = 0.0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for filename, filematrices, error, elapsed in executor.map(expandfile, filenames, chunksize=16):
+            busytime += elapsed
+            if error is not None:
+                errors[filename] = error
+            matrices.update(filematrices)
+    return matrices, errors, busytime
+
+# Function to print the matrix of each role, marking wildcard grants
+def printmatrices(matrices):
+    for role in sorted(matrices):
+        print (role)
+        for row in matrices[role]:
+            print ('  {} {:<40} {}{}'.format(row[0], row[1], row[2], '  [WILDCARD]' if iswildcard(row) else ''))
+
+# Function to compare the matrices against a baseline, printing the differences.
+# Returns the number of roles that differ.
+def diffmatrices(matrices, baseline):
+    changed = 0
+    for role in sorted(set(matrices) | set(baseline)):
+        current = set(tuple(row) for row in matrices.get(role, []))
+        previous = set(tuple(row) for row in baseline.get(role, []))
+        if current == previous:
+            continue
+        changed += 1
+        if role not in baseline:
+            print ('+ {} (new role)'.format(role))
+        elif role not in matrices:
+            print ('- {} (removed role)'.format(role))
+        else:
+            print ('~ {}'.format(role))
+        for row in sorted(previous - current):
+            print ('  - {} {} {}'.format(*row))
+        for row in sorted(current - previous):
+            print ('  + {} {} {}{}'.format(row[0], row[1], row[2], '  [WILDCARD]' if iswildcard(row) else ''))
+    return changed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Show the permissions of the roles the ExecutionRoleBuilder macro will build')
+    parser.add_argument('paths', nargs='+', metavar='path', help='template files, directories or globs')
+    parser.add_argument('--baseline', help='compare the roles against this baseline and exit non-zero if they differ')
+    parser.add_argument('--write-baseline', help='save the roles to this file as a new baseline')
+    parser.add_argument('--fail-on-wildcard', action='store_true', help='exit non-zero if any role is granted a wildcard')
+    parser.add_argument('--quiet', action='store_true', help="don't print the matrix of each role")
+    parser.add_argument('--jobs', type=int, help='number of processes to use (default: one per CPU)')
+    args = parser.parse_args(argv)
+
+    # The per-role summary lines from the macro would drown out the matrix
+    logging.getLogger().setLevel(logging.WARNING)
+
+    started = time.time()
+    filenames = findtemplates(args.paths)
+    matrices, errors, busytime = expandall(filenames, args.jobs)
+    elapsed = time.time() - started
+
+    if not args.quiet and not args.baseline:
+        printmatrices(matrices)
+    for filename in sorted(errors):
+        print ('{}: {}'.format(filename, errors[filename]))
+
+    failed = bool(errors)
+    wildcards = sum(1 for rows in matrices.values() if any(iswildcard(row) for row in rows))
+    if args.baseline:
+        with open(args.baseline) as baselinefile:
+            changed = diffmatrices(matrices, json.load(baselinefile))
+        print ('{} roles differ from {}'.format(changed, args.baseline))
+        failed = failed or changed > 0
+    if args.write_baseline:
+        with open(args.write_baseline, 'w') as baselinefile:
+            json.dump(matrices, baselinefile, indent=1, sort_keys=True)
+    if args.fail_on_wildcard and wildcards:
+        failed = True
+
+    print ('Expanded {} roles from {} templates ({} failed, {} roles with wildcards) in {:.2f}s ({:.2f}s of processing, {:.0f} roles/s)'.format(
+        len(matrices), len(filenames), len(errors), wildcards, elapsed, busytime, len(matrices) / elapsed if elapsed else 0))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
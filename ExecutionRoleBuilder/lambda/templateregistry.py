@@ -0,0 +1,192 @@
+#!/usr/bin/python
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+# This file holds the registry used to look up policy templates by service and action group.
+# Templates are loaded from a library of files laid out as <service>/<actiongroup>.json
+# (or .yaml/.yml), either in a local directory or under an S3 prefix, e.g.
+#
+#   templates/sns/Publish.json
+#   templates/sqs/ReadWrite.yaml
+#
+# Each file holds a single policy in the same format as the templates in policytemplates.py.
+# Templates from the library are added to, or replace, the built-in templates.
+
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Try to load YAML support, templates in the library can then be written as YAML too
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# File extensions recognised as policy templates
+templateextensions = ('.json', '.yaml', '.yml')
+
+# Function to parse the text of a template file according to its extension
+def parsetemplate(location, text):
+    if location.endswith('.json'):
+        return json.loads(text)
+    if yaml is None:
+        raise Exception('Cannot load policy template {} as PyYAML is not installed'.format(location))
+    return yaml.safe_load(text)
+
+# Function to work out the (service, action group) a template file is for from its path,
+# relative to the root of the library. Returns None for files that aren't templates.
+def templatekey(relativepath):
+    parts = relativepath.replace('\\', '/').split('/')
+    if len(parts) != 2:
+        return None
+    service, filename = parts
+    actiongroup, extension = os.path.splitext(filename)
+    if extension.lower() not in templateextensions:
+        return None
+    return (service.lower(), actiongroup)
+
+# Template library stored in a local directory. No network access is needed,
+# so the library can be tested offline and bundled with the function.
+class DirectoryBackend(object):
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return 'DirectoryBackend({!r})'.format(self.path)
+
+    # Returns {(service, actiongroup): (location, version)} for every template in the library.
+    # The modification time and size of a file are used as its version.
+    def list(self):
+        entries = {}
+        if not os.path.isdir(self.path):
+            return entries
+        for root, dirs, files in os.walk(self.path):
+            for filename in files:
+                location = os.path.join(root, filename)
+                key = templatekey(os.path.relpath(location, self.path))
+                if key is not None:
+                    stat = os.stat(location)
+                    entries[key] = (location, (stat.st_mtime, stat.st_size))
+        return entries
+
+    def fetch(self, location):
+        with open(location) as templatefile:
+            return templatefile.read()
+
+# Template library stored under a prefix in an S3 bucket. Listing the prefix returns
+# the ETag of every object, so only templates that have changed are downloaded again.
+class S3Backend(object):
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self._client = None
+
+    def __repr__(self):
+        return 'S3Backend({!r}, {!r})'.format(self.bucket, self.prefix)
+
+    # The client is created on first use, so the directory backend never needs boto3
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('s3')
+        return self._client
+
+    def list(self):
+        entries = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get('Contents', []):
+                key = templatekey(item['Key'][len(self.prefix):])
+                if key is not None:
+                    entries[key] = (item['Key'], item['ETag'])
+        return entries
+
+    def fetch(self, location):
+        body = self.client.get_object(Bucket=self.bucket, Key=location)['Body'].read()
+        return body.decode('utf-8')
+
+# Function to create the backend for a template source, which is either a local directory
+# or an S3 URL (s3://bucket/prefix)
+def backendforsource(source):
+    if source.startswith('s3://'):
+        bucket, _, prefix = source[len('s3://'):].partition('/')
+        return S3Backend(bucket, prefix)
+    return DirectoryBackend(source)
+
+# Registry of compiled policy templates indexed by (service, action group).
+# The library is listed again once the TTL has passed, and only templates whose
+# version (mtime or ETag) has changed are fetched and compiled again, so warm
+# invocations of the function don't reload anything.
+class PolicyTemplateRegistry(object):
+    def __init__(self, backend, compiler, builtins=None, ttl=300):
+        self.backend = backend
+        self.compiler = compiler
+        self.ttl = ttl
+        self.builtins = {}
+        for service, templates in (builtins or {}).items():
+            for actiongroup, template in templates.items():
+                self.builtins[(service, actiongroup)] = compiler(template)
+        self.templates = dict(self.builtins)
+        self.versions = {}
+        self.lastchecked = None
+
+    # Function to reload any templates that have changed in the library since it was last checked.
+    # If the library can't be listed, or a template can't be loaded, the templates already
+    # loaded are kept and it is tried again once the TTL has passed.
+    def refresh(self, force=False):
+        now = time.time()
+        if not force and self.lastchecked is not None and now - self.lastchecked < self.ttl:
+            return
+        self.lastchecked = now
+        try:
+            listing = self.backend.list()
+        except Exception as e:
+            logger.error('cannot list policy templates in %s: %s', self.backend, e)
+            return
+        changed = 0
+        for key, (location, version) in listing.items():
+            if self.versions.get(key) == version:
+                continue
+            logger.debug('loading policy template %s from %s', key, location)
+            try:
+                self.templates[key] = self.compiler(parsetemplate(location, self.backend.fetch(location)))
+            except Exception as e:
+                logger.error('cannot load policy template %s: %s', location, e)
+                continue
+            self.versions[key] = version
+            changed += 1
+        # Templates removed from the library fall back to the built-in template, if there is one
+        for key in [key for key in self.versions if key not in listing]:
+            del self.versions[key]
+            if key in self.builtins:
+                self.templates[key] = self.builtins[key]
+            else:
+                del self.templates[key]
+            changed += 1
+        if changed:
+            logger.info('%d policy templates changed in %s', changed, self.backend)
+
+    # Function to look up the compiled template for a service and action group.
+    # Returns None if there is no such template.
+    def lookup(self, service, actiongroup):
+        self.refresh()
+        return self.templates.get((service.lower(), actiongroup))
+
+    # Function to list the (service, action group) pairs that have a template
+    def keys(self):
+        self.refresh()
+        return sorted(self.templates)
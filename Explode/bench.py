@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Benchmark of exploding a resource into 10,000 copies.
+
+Compares a cartesian ExplodeMap over three mappings (100 x 10 x 10) with the
+same copies written out as one flattened mapping of 10,000 entries, which is
+what had to be maintained by hand before ExplodeMap accepted a list:
+
+    python bench.py
+"""
+
+import copy
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lambda'))
+
+import explode
+
+SHAPE = (100, 10, 10)
+
+
+def synthetic_resource(explode_map, name, region, environment):
+    return {
+        'Type': 'AWS::SQS::Queue',
+        'ExplodeMap': explode_map,
+        'Properties': {
+            'QueueName': '!Explode {}-!Explode {}-!Explode {}'.format(name, region, environment),
+            'Tags': [{'Key': 'tag{}'.format(i), 'Value': 'static value {}'.format(i)} for i in range(10)],
+        },
+    }
+
+
+def cartesian_template():
+    shards, regions, environments = SHAPE
+    return {
+        'Mappings': {
+            'Shards': {'S{}'.format(i): {'Name': 'shard{}'.format(i)} for i in range(shards)},
+            'Regions': {'R{}'.format(i): {'Name': 'region{}'.format(i)} for i in range(regions)},
+            'Environments': {'E{}'.format(i): {'Name': 'env{}'.format(i)} for i in range(environments)},
+        },
+        'Resources': {
+            'Queue': synthetic_resource(
+                ['Shards', 'Regions', 'Environments'], 'Shards.Name', 'Regions.Name', 'Environments.Name'),
+        },
+    }
+
+
+def flattened_template():
+    shards, regions, environments = SHAPE
+    mapping = {}
+    for shard in range(shards):
+        for region in range(regions):
+            for environment in range(environments):
+                mapping['S{}R{}E{}'.format(shard, region, environment)] = {
+                    'Shard': 'shard{}'.format(shard),
+                    'Region': 'region{}'.format(region),
+                    'Environment': 'env{}'.format(environment),
+                }
+    return {
+        'Mappings': {'Flattened': mapping},
+        'Resources': {'Queue': synthetic_resource('Flattened', 'Shard', 'Region', 'Environment')},
+    }
+
+
+def measure(template):
+    # handle_transform modifies the template it is given, so work on a fresh copy each time
+    seconds = min(timeit.repeat(
+        'explode.handle_transform(template)',
+        setup='template = copy.deepcopy(original)',
+        globals={'explode': explode, 'copy': copy, 'original': template},
+        number=1, repeat=5))
+    working = copy.deepcopy(template)
+    tracemalloc.start()
+    resources = len(explode.handle_transform(working)['Resources'])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return resources, seconds, peak
+
+
+def main():
+    print('{:<28} {:>9} {:>9} {:>10}'.format('ExplodeMap', 'resources', 'time', 'peak'))
+    for label, template in (('cartesian 100x10x10', cartesian_template()),
+                            ('flattened 10,000 entries', flattened_template())):
+        resources, seconds, peak = measure(template)
+        print('{:<28} {:>9} {:>8.3f}s {:>8.1f}MB'.format(label, resources, seconds, peak / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,43 +2,266 @@
 CloudFormation template transform macro: Explode
 """
 
+import itertools
 import re
 import sys
 
 
-EXPLODE_RE = re.compile(r'(?i)!Explode (?P<explode_key>\w+)')
+# Keys may be namespaced by mapping name, e.g. !Explode RegionMap.Name
+EXPLODE_RE = re.compile(r'(?i)!Explode (\w+)(?:\.(\w+))?')
 
 
-def walk_resource(resource, map_data):
-    """Recursively process a resource."""
-    new_resource = {}
-    for key, value in resource.items():
-        if isinstance(value, dict):
-            new_resource[key] = walk_resource(value, map_data)
-        elif isinstance(value, list):
-            new_resource[key] = [walk_resource(x, map_data) for x in value]
-        elif isinstance(value, str):
-            match = EXPLODE_RE.search(value)
-            while match:
-                explode_key = match.group('explode_key')
-                try:
-                    replace_value = map_data[explode_key]
-                except KeyError:
-                    print("Missing item {} in mapping while processing {}: {}".format(
-                        explode_key,
-                        key,
-                        value))
-                if isinstance(replace_value, int):
-                    value = replace_value
-                    # No further explosion is possible on an int
-                    match = None
-                else:
-                    value = value.replace(match.group(0), replace_value)
-                    match = EXPLODE_RE.search(value)
-            new_resource[key] = value
+def split_tokens(value, namespaces):
+    """Split a string into literal text (even indices) and explode keys (odd indices)."""
+    matches = EXPLODE_RE.split(value)
+    parts = [matches[0]]
+    for index in range(1, len(matches), 3):
+        key, sub_key, text = matches[index:index + 3]
+        if sub_key is None:
+            parts.extend([key, text])
+        elif key in namespaces:
+            parts.extend(['{}.{}'.format(key, sub_key), text])
+        else:
+            # Not a mapping name, so the dot is just part of the text
+            parts.extend([key, '.' + sub_key + text])
+    return parts
+
+
+def compile_resource(resource, namespaces=()):
+    """Find the !Explode tokens in a resource once, ahead of processing any mapping entries.
+
+    Returns None for a subtree without tokens (which can then be shared between
+    all exploded copies), or a plan of what to substitute:
+      ('str', parts)   - the string split on the tokens; keys are at odd indices
+      ('dict', plans)  - {key: plan} for the entries containing tokens
+      ('list', plans)  - {index: plan} for the items containing tokens
+    """
+    if isinstance(resource, str):
+        parts = split_tokens(resource, namespaces)
+        if len(parts) == 1:
+            return None
+        return ('str', parts)
+    if isinstance(resource, dict):
+        plans = {}
+        for key, value in resource.items():
+            plan = compile_resource(value, namespaces)
+            if plan is not None:
+                plans[key] = plan
+        return ('dict', plans) if plans else None
+    if isinstance(resource, list):
+        plans = {}
+        for index, value in enumerate(resource):
+            plan = compile_resource(value, namespaces)
+            if plan is not None:
+                plans[index] = plan
+        return ('list', plans) if plans else None
+    return None
+
+
+def apply_plan(resource, plan, map_data):
+    """Build a copy of a compiled resource for one mapping entry."""
+    if plan is None:
+        return resource
+    kind, plans = plan
+    if kind == 'str':
+        parts = list(plans)
+        for index in range(1, len(parts), 2):
+            explode_key = parts[index]
+            try:
+                replace_value = map_data[explode_key]
+            except KeyError:
+                print("Missing item {} in mapping while processing: {}".format(
+                    explode_key,
+                    resource))
+                raise
+            if not isinstance(replace_value, str):
+                # A non-string value (e.g. an int) replaces the whole string
+                return replace_value
+            parts[index] = replace_value
+        return ''.join(parts)
+    if kind == 'dict':
+        return {
+            key: apply_plan(value, plans.get(key), map_data)
+            for key, value in resource.items()
+        }
+    return [
+        apply_plan(value, plans.get(index), map_data)
+        for index, value in enumerate(resource)
+    ]
+
+
+def mapping_rows(resource_name, explode_map, mappings):
+    """Look up the mappings an ExplodeMap refers to.
+
+    Returns the list of mapping names and, for each of them, a list of
+    (instance, entry, map_data) where map_data holds the values that the
+    !Explode keys resolve to for that entry.
+    """
+    map_names = explode_map if isinstance(explode_map, list) else [explode_map]
+    map_entries = []
+    for map_name in map_names:
+        try:
+            map_entries.append(list(mappings[map_name].items()))
+        except KeyError:
+            # This resource refers to a mapping entry which doesn't exist, so
+            # fail
+            print('Unable to find mapping {} for exploding resource {}'.format(map_name, resource_name))
+            raise
+
+    # Keys can always be used namespaced by their mapping name, and also
+    # bare as long as only one of the mappings defines them
+    seen_keys = set()
+    ambiguous_keys = set()
+    for entries in map_entries:
+        keys = set(key for _, entry in entries for key in entry)
+        ambiguous_keys |= seen_keys & keys
+        seen_keys |= keys
+    rows = []
+    for map_name, entries in zip(map_names, map_entries):
+        map_rows = []
+        for instance, entry in entries:
+            map_data = {
+                '{}.{}'.format(map_name, key): value
+                for key, value in entry.items()
+            }
+            map_data.update(
+                (key, value) for key, value in entry.items()
+                if key not in ambiguous_keys
+            )
+            map_rows.append((instance, entry, map_data))
+        rows.append(map_rows)
+    return map_names, rows
+
+
+def exploded_names(resource_name, rows):
+    """Lazily generate (name, map_data) for each copy of an exploding resource."""
+    if len(rows) == 1:
+        for instance, entry, map_data in rows[0]:
+            if 'ResourceName' in entry:
+                yield entry['ResourceName'], map_data
+            else:
+                yield resource_name + instance, map_data
+        return
+
+    for combination in itertools.product(*rows):
+        map_data = {}
+        for _, _, row_data in combination:
+            map_data.update(row_data)
+        yield resource_name + ''.join(instance for instance, _, _ in combination), map_data
+
+
+def explode_resource(resource_name, resource, explode_map, mappings):
+    """Lazily generate (name, resource) for each copy of an exploding resource.
+
+    explode_map is either a mapping name or a list of them, in which case one
+    copy is generated for every combination of their entries.
+    """
+    map_names, rows = mapping_rows(resource_name, explode_map, mappings)
+    plan = compile_resource(resource, set(map_names))
+    for new_resource_name, map_data in exploded_names(resource_name, rows):
+        yield new_resource_name, apply_plan(resource, plan, map_data)
+
+
+def plan_keys(plan):
+    """Yield every !Explode key used in a compiled resource."""
+    if plan is None:
+        return
+    kind, plans = plan
+    if kind == 'str':
+        for key in plans[1::2]:
+            yield key
+    else:
+        for sub_plan in plans.values():
+            for key in plan_keys(sub_plan):
+                yield key
+
+
+def validate_resource(resource_name, resource, explode_map, mappings):
+    """Check an exploding resource against its mappings without expanding it.
+
+    Returns a list of error messages, which is empty if the resource is valid.
+    """
+    map_names = explode_map if isinstance(explode_map, list) else [explode_map]
+    if not all(isinstance(map_name, str) for map_name in map_names):
+        return ['Resource {}: ExplodeMap must be a mapping name or a list of them'.format(resource_name)]
+    errors = [
+        'Resource {}: mapping {} not found'.format(resource_name, map_name)
+        for map_name in map_names
+        if map_name not in mappings
+    ]
+    errors.extend(
+        'Resource {}: mapping {} is not a map'.format(resource_name, map_name)
+        for map_name in map_names
+        if map_name in mappings and not isinstance(mappings[map_name], dict)
+    )
+    if errors:
+        return errors
+    for map_name in map_names:
+        for instance, entry in mappings[map_name].items():
+            if not isinstance(entry, dict):
+                errors.append('Resource {}: entry {} in mapping {} is not a map'.format(
+                    resource_name, instance, map_name))
+    if errors:
+        return errors
+
+    defined_by = {}
+    for map_name in map_names:
+        for key in set(key for entry in mappings[map_name].values() for key in entry):
+            defined_by.setdefault(key, []).append(map_name)
+
+    keys = set(plan_keys(compile_resource(resource, set(map_names))))
+    for key in sorted(keys):
+        if '.' in key:
+            map_name, map_key = key.split('.', 1)
+        elif len(defined_by.get(key, [])) == 1:
+            map_name, map_key = defined_by[key][0], key
+        elif key in defined_by:
+            errors.append('Resource {}: key {} is ambiguous between mappings {}'.format(
+                resource_name, key, ', '.join(defined_by[key])))
+            continue
+        else:
+            errors.append('Resource {}: key {} not found in mapping {}'.format(
+                resource_name, key, ', '.join(map_names)))
+            continue
+        for instance, entry in mappings[map_name].items():
+            if map_key not in entry:
+                errors.append('Resource {}: key {} missing from entry {} in mapping {}'.format(
+                    resource_name, key, instance, map_name))
+    return errors
+
+
+def validate_template(template):
+    """Check every exploding resource in a template without expanding them.
+
+    Returns a list of all the errors found, which is empty if the template is
+    valid.
+    """
+    mappings = template.get('Mappings', {})
+    errors = []
+    names = set()
+    for resource_name, resource in template.get('Resources', {}).items():
+        if 'ExplodeMap' not in resource:
+            new_names = [resource_name]
         else:
-            new_resource[key] = value
-    return new_resource
+            resource_errors = validate_resource(resource_name, resource, resource['ExplodeMap'], mappings)
+            errors.extend(resource_errors)
+            if resource_errors:
+                continue
+            _, rows = mapping_rows(resource_name, resource['ExplodeMap'], mappings)
+            new_names = (name for name, _ in exploded_names(resource_name, rows))
+        for name in new_names:
+            if name in names:
+                errors.append('Duplicate resource name: {}'.format(name))
+            names.add(name)
+    return errors
+
+
+def add_resource(new_resources, resource_name, resource):
+    """Add a resource to the output, refusing to overwrite an existing one."""
+    if resource_name in new_resources:
+        print('Duplicate resource name {} while exploding resources'.format(resource_name))
+        raise ValueError('Duplicate resource name: {}'.format(resource_name))
+    new_resources[resource_name] = resource
 
 
 def handle_transform(template):
@@ -53,23 +276,10 @@ def handle_transform(template):
         except KeyError:
             # This resource does not have an ExplodeMap, so copy it verbatim
             # and move on
-            new_resources[resource_name] = resource
+            add_resource(new_resources, resource_name, resource)
             continue
-        try:
-            explode_map_data = mappings[explode_map]
-        except KeyError:
-            # This resource refers to a mapping entry which doesn't exist, so
-            # fail
-            print('Unable to find mapping for exploding resource {}'.format(resource_name))
-            raise
-        resource_instances = explode_map_data.keys()
-        for resource_instance in resource_instances:
-            new_resource = walk_resource(resource, explode_map_data[resource_instance])
-            if 'ResourceName' in explode_map_data[resource_instance]:
-                new_resource_name = explode_map_data[resource_instance]['ResourceName']
-            else:
-                new_resource_name = resource_name + resource_instance
-            new_resources[new_resource_name] = new_resource
+        for new_resource_name, new_resource in explode_resource(resource_name, resource, explode_map, mappings):
+            add_resource(new_resources, new_resource_name, new_resource)
     template['Resources'] = new_resources
     return template
 
@@ -77,43 +287,280 @@ def handle_transform(template):
 def handler(event, _context):
     """Handle invocation in Lambda (when CloudFormation processes the Macro)"""
     fragment = event["fragment"]
-    status = "success"
-
-    try:
-        fragment = handle_transform(event["fragment"])
-    except:
-        status = "failure"
-
-    return {
+    response = {
         "requestId": event["requestId"],
-        "status": status,
+        "status": "success",
         "fragment": fragment,
     }
 
+    try:
+        # Report every problem with the template at once, rather than failing on
+        # the first one part way through the expansion
+        errors = validate_template(fragment)
+        if errors:
+            for error in errors:
+                print(error)
+            response["status"] = "failure"
+            response["errorMessage"] = "; ".join(errors)
+            return response
+
+        response["fragment"] = handle_transform(fragment)
+    except Exception as e:
+        print("Unable to explode template: {}".format(e))
+        response["status"] = "failure"
+        response["errorMessage"] = str(e)
+
+    return response
+
+
+# CloudFormation's short-form YAML tags and the intrinsic functions they stand for
+CFN_TAGS = {
+    'Ref': 'Ref',
+    'Condition': 'Condition',
+    'Base64': 'Fn::Base64',
+    'Cidr': 'Fn::Cidr',
+    'FindInMap': 'Fn::FindInMap',
+    'GetAtt': 'Fn::GetAtt',
+    'GetAZs': 'Fn::GetAZs',
+    'ImportValue': 'Fn::ImportValue',
+    'Join': 'Fn::Join',
+    'Select': 'Fn::Select',
+    'Split': 'Fn::Split',
+    'Sub': 'Fn::Sub',
+    'Transform': 'Fn::Transform',
+    'And': 'Fn::And',
+    'Equals': 'Fn::Equals',
+    'If': 'Fn::If',
+    'Not': 'Fn::Not',
+    'Or': 'Fn::Or',
+}
+
+
+def cfn_yaml_loader():
+    """Build a YAML loader that understands CloudFormation's short-form tags."""
+    import yaml
+
+    class CloudFormationLoader(yaml.SafeLoader):
+        pass
+
+    def construct_intrinsic(loader, tag_suffix, node):
+        if tag_suffix == 'Explode':
+            # Keep !Explode as the string form the macro looks for
+            return '!Explode {}'.format(loader.construct_scalar(node))
+        function = CFN_TAGS[tag_suffix]
+        if isinstance(node, yaml.ScalarNode):
+            value = loader.construct_scalar(node)
+            if function == 'Fn::GetAtt':
+                value = value.split('.', 1)
+        elif isinstance(node, yaml.SequenceNode):
+            value = loader.construct_sequence(node, deep=True)
+        else:
+            value = loader.construct_mapping(node, deep=True)
+        return {function: value}
+
+    for tag in list(CFN_TAGS) + ['Explode']:
+        CloudFormationLoader.add_constructor('!' + tag, lambda loader, node, tag=tag: construct_intrinsic(loader, tag, node))
+    return CloudFormationLoader
+
+
+def load_template(filename):
+    """Load a template from a JSON or YAML file."""
+    import json
+    if filename.endswith(".yml") or filename.endswith(".yaml"):
+        import yaml
+        with open(filename, 'r') as file_handle:
+            return yaml.load(file_handle, Loader=cfn_yaml_loader())
+    elif filename.endswith(".json"):
+        with open(filename, 'r') as file_handle:
+            return json.load(file_handle)
+    raise ValueError("Template file needs to end .yaml, .yml or .json")
+
+
+TEMPLATE_EXTENSIONS = ('.json', '.yaml', '.yml')
+
+
+def glob_root(pattern):
+    """The leading directories of a glob pattern that contain no wildcards."""
+    import os
+    parts = []
+    for part in pattern.split(os.sep)[:-1]:
+        if re.search(r'[*?[]', part):
+            break
+        parts.append(part)
+    return os.sep.join(parts)
+
+
+def find_templates(paths):
+    """Expand files, directories and globs into (template, output name) pairs.
+
+    Output names are relative to the directory given, or to the part of a
+    glob before its first wildcard, so that templates with the same file
+    name in different directories keep apart.
+    """
+    import glob
+    import os
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    if filename.endswith(TEMPLATE_EXTENSIONS):
+                        template = os.path.join(root, filename)
+                        yield template, os.path.relpath(template, path)
+        else:
+            root = glob_root(path) or os.curdir
+            for template in sorted(glob.glob(path, recursive=True)) or [path]:
+                yield template, os.path.relpath(template, root)
+
+
+def expand_file(filename, output_filename):
+    """Expand a single template into a JSON file, for use from a process pool.
+
+    Returns (filename, errors, seconds taken).
+    """
+    import json
+    import os
+    import time
+    started = time.time()
+    try:
+        template = load_template(filename)
+        errors = validate_template(template)
+        if not errors:
+            new_fragment = handle_transform(template)
+            os.makedirs(os.path.dirname(output_filename) or '.', exist_ok=True)
+            with open(output_filename, 'w') as file_handle:
+                json.dump(new_fragment, file_handle)
+    except Exception as e:
+        errors = [str(e)]
+    return filename, errors, time.time() - started
+
+
+def expand_batch(paths, output_dir, jobs=None):
+    """Expand many templates in parallel into output_dir.
+
+    Templates whose content (and this macro's code) have not changed since
+    they were last expanded into output_dir are skipped.
+    Returns True if every template was expanded successfully.
+    """
+    import hashlib
+    import json
+    import os
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+
+    started = time.time()
+    collided = False
+    hashes_filename = os.path.join(output_dir, '.explode-hashes.json')
+    try:
+        with open(hashes_filename, 'r') as file_handle:
+            hashes = json.load(file_handle)
+    except (IOError, ValueError):
+        hashes = {}
+    with open(__file__, 'rb') as file_handle:
+        code_hash = hashlib.sha256(file_handle.read()).hexdigest()
+
+    pending = {}
+    skipped = 0
+    sources = {}
+    for filename, output_name in find_templates(paths):
+        output_filename = os.path.join(output_dir, os.path.splitext(output_name)[0] + '.json')
+        if output_filename in sources:
+            if sources[output_filename] != filename:
+                print("{} and {} would both be expanded into {}".format(
+                    sources[output_filename], filename, output_filename))
+                collided = True
+            continue
+        sources[output_filename] = filename
+        with open(filename, 'rb') as file_handle:
+            content_hash = hashlib.sha256(file_handle.read()).hexdigest() + code_hash
+        if hashes.get(output_filename) == content_hash and os.path.exists(output_filename):
+            skipped += 1
+            continue
+        pending[filename] = (output_filename, content_hash)
+
+    if collided:
+        return False
+
+    failed = 0
+    busy_time = 0.0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(expand_file, filename, output_filename)
+            for filename, (output_filename, _) in pending.items()
+        ]
+        for future in futures:
+            filename, errors, elapsed = future.result()
+            busy_time += elapsed
+            output_filename, content_hash = pending[filename]
+            if errors:
+                failed += 1
+                hashes.pop(output_filename, None)
+                for error in errors:
+                    print("{}: {}".format(filename, error))
+            else:
+                hashes[output_filename] = content_hash
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(hashes_filename, 'w') as file_handle:
+        json.dump(hashes, file_handle, indent=2, sort_keys=True)
+
+    print("Expanded {} templates ({} failed), skipped {} unchanged in {:.2f}s ({:.2f}s of processing)".format(
+        len(pending) - failed, failed, skipped, time.time() - started, busy_time))
+    return failed == 0
+
 
 if __name__ == "__main__":
     """
     If run from the command line, parse the file specified and output it
-    This is quite naive; CF YAML tags like !GetAtt will break it (as will
-    !Explode, but you can hide that in a string). Probably best to use JSON.
-    Releatedly, always outputs JSON.
+    as JSON. CloudFormation's short-form YAML tags such as !GetAtt are
+    understood, and !Explode can be used as a tag or hidden in a string.
+
+    With --check, only validate the files given and report any errors, which
+    is much quicker than expanding them.
+
+    With --output-dir, expand any number of files, directories or globs in
+    parallel into JSON files under the given directory, skipping templates
+    that have not changed since the last run.
     """
-    if len(sys.argv) == 2:
-        import json
-        filename = sys.argv[1]
-        if filename.endswith(".yml") or filename.endswith(".yaml"):
-            try:
-                import yaml
-            except ImportError:
-                print("Please install PyYAML to test yaml templates")
-                sys.exit(1)
-            with open(filename, 'r') as file_handle:
-                loaded_fragment = yaml.safe_load(file_handle)
-        elif filename.endswith(".json"):
-            with open(sys.argv[1], 'r') as file_handle:
-                loaded_fragment = json.load(file_handle)
-        else:
-            print("Test file needs to end .yaml, .yml or .json")
-            sys.exit(1)
-        new_fragment = handle_transform(loaded_fragment)
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description="Run the Explode macro locally")
+    parser.add_argument("--check", action="store_true",
+                        help="validate the templates without expanding them")
+    parser.add_argument("--output-dir",
+                        help="expand the templates into this directory")
+    parser.add_argument("--jobs", type=int,
+                        help="number of processes to use with --output-dir (default: one per CPU)")
+    parser.add_argument("paths", nargs="+", metavar="path",
+                        help="template files, or with --check or --output-dir also directories or globs")
+    args = parser.parse_args()
+
+    try:
+        if args.check:
+            failed = False
+            for filename, _ in find_templates(args.paths):
+                # A file that can't be read or parsed is reported like any other
+                # error, so that the rest of the files are still checked
+                try:
+                    errors = validate_template(load_template(filename))
+                except ImportError:
+                    raise
+                except Exception as e:
+                    errors = [str(e)]
+                for error in errors:
+                    print("{}: {}".format(filename, error))
+                    failed = True
+            sys.exit(1 if failed else 0)
+
+        if args.output_dir:
+            sys.exit(0 if expand_batch(args.paths, args.output_dir, args.jobs) else 1)
+
+        if len(args.paths) != 1:
+            parser.error("only one template can be expanded at a time without --output-dir")
+        new_fragment = handle_transform(load_template(args.paths[0]))
         print(json.dumps(new_fragment))
+    except ImportError:
+        print("Please install PyYAML to test yaml templates")
+        sys.exit(1)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
@@ -13,12 +13,19 @@
 
 import boto3
 import os
+import pipeline
 
 LAMBDA_ARN = os.environ["LAMBDA_ARN"]
 
 s3_client = boto3.client("s3")
 
 
+def check_compress(settings):
+    # Values from intrinsic functions can only be checked when the object is written
+    if isinstance(settings.get("Compress"), str) and settings["Compress"] not in pipeline.ENCODINGS:
+        raise Exception("Compress must be one of: {}".format(", ".join(pipeline.ENCODINGS)))
+
+
 def handle_template(request_id, template):
     new_resources = {}
 
@@ -42,6 +49,8 @@ def handle_template(request_id, template):
 
             target = props["Target"]
 
+            check_compress(target)
+
             if "ACL" not in target:
                 target["ACL"] = "private"
 
@@ -65,6 +74,51 @@ def handle_template(request_id, template):
                 "Properties": resource_props,
             }
 
+        elif resource["Type"] == "AWS::S3::ObjectSet":
+            props = resource["Properties"]
+
+            if len([prop for prop in props if prop in ["Objects", "Source"]]) != 1:
+                raise Exception("You must specify exactly one of: Objects, Source")
+
+            for obj in props.get("Objects", []):
+                if "Key" not in obj:
+                    raise Exception("Every object in Objects needs a Key")
+
+                if len([prop for prop in obj if prop in ["Body", "Base64Body", "Source"]]) != 1:
+                    raise Exception(
+                        "You must specify exactly one of: Body, Base64Body, Source for {}".format(obj["Key"])
+                    )
+
+                check_compress(obj)
+
+            target = props["Target"]
+
+            check_compress(target)
+
+            # Every object under the prefix belongs to the set and is deleted with it
+            if "Source" in props and not target.get("Prefix"):
+                raise Exception("A set copied from a Source needs a Target Prefix of its own")
+
+            if "ACL" not in target:
+                target["ACL"] = "private"
+
+            resource_props = {
+                "ServiceToken": LAMBDA_ARN,
+                "Target": target,
+            }
+
+            if "Objects" in props:
+                resource_props["Objects"] = props["Objects"]
+
+            elif "Source" in props:
+                resource_props["Source"] = props["Source"]
+
+            new_resources[name] = {
+                "Type": "Custom::S3ObjectSet",
+                "Version": "1.0",
+                "Properties": resource_props,
+            }
+
     for name, resource in list(new_resources.items()):
         template["Resources"][name] = resource
 
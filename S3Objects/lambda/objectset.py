@@ -0,0 +1,272 @@
+# Copyright 2018-2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+from botocore.exceptions import BotoCoreError, ClientError
+import os
+import pipeline
+import random
+import time
+import transfer
+
+# How many times a failed object is tried before the whole set fails
+MAX_ATTEMPTS = int(os.environ.get("MAX_ATTEMPTS", 5))
+
+# The delay before the first retry, which doubles for each retry after that
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", 0.2))
+
+# delete_objects accepts at most this many keys at once
+DELETE_BATCH_SIZE = 1000
+
+# Error codes from S3 that are worth retrying
+RETRYABLE_ERRORS = {
+    "InternalError",
+    "RequestTimeout",
+    "ServiceUnavailable",
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+}
+
+# Properties of an object in a set that aren't passed to S3 as they are
+OBJECT_CONTENT = ["Body", "Base64Body", "Source"]
+
+
+def is_retryable(error):
+    """
+    Returns True if an error from S3 may go away when the request is retried
+    """
+
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code")
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+
+        return code in RETRYABLE_ERRORS or status >= 500
+
+    return isinstance(error, BotoCoreError)
+
+
+def with_retries(name, function):
+    """
+    Call function, retrying with exponential backoff and full jitter if it fails
+    with a retryable error. Errors are raised with the name of what failed.
+    """
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return function()
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS or not is_retryable(e):
+                raise Exception(f"{name}: {e}") from e
+
+            time.sleep(random.uniform(0, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+def target_key(target, key):
+    return target.get("Prefix", "") + key
+
+
+def object_settings(obj):
+    """
+    The settings of an object in a set, other than its content
+    """
+
+    return {key: value for key, value in obj.items() if key not in OBJECT_CONTENT}
+
+
+def write_task(key, write, etag=None, expected_etag=None):
+    """
+    A task that calls write with retries and returns (key, True).
+    If etag is the current ETag of the object and matches the one
+    expected_etag() returns, nothing is written and it returns (key, False).
+    """
+
+    def task():
+        if etag is not None and etag == with_retries(key, expected_etag):
+            return key, False
+
+        with_retries(key, write)
+
+        return key, True
+
+    return task
+
+
+def target_etags(client, target):
+    """
+    The ETag of every object under the target prefix, by key
+    """
+
+    return {
+        item["Key"]: item["ETag"]
+        for item in source_objects(client, {"Bucket": target["Bucket"], "Prefix": target.get("Prefix", "")})
+    }
+
+
+def object_tasks(client, target, properties, unchanged=None):
+    """
+    Yield a task for each object in the set that writes it to the target.
+    unchanged is the current ETag, by key, of the objects whose settings
+    haven't changed, which are skipped if their content hasn't changed either.
+    Each task returns the key and whether it was written.
+    """
+
+    unchanged = unchanged or {}
+
+    # The ACL and pipeline settings of the target apply to every object, unless the object has its own
+    extra_args = {key: target[key] for key in ["ACL"] + pipeline.PIPELINE_SETTINGS if key in target}
+
+    if "Objects" in properties:
+        for obj in properties["Objects"]:
+            # Any other properties of the object (e.g. ContentType) are passed on to S3
+            object_target = dict(extra_args)
+            object_target.update({key: value for key, value in obj.items() if key not in OBJECT_CONTENT})
+            object_target.update({"Bucket": target["Bucket"], "Key": target_key(target, obj["Key"])})
+
+            if "Source" in obj:
+                write = lambda obj=obj, object_target=object_target: transfer.copy_object(client, obj["Source"], object_target)
+                # Objects copied in one request keep the ETag of their source
+                expected_etag = lambda obj=obj: client.head_object(**obj["Source"])["ETag"]
+            else:
+                write = lambda obj=obj, object_target=object_target: transfer.put_object(
+                    client, object_target, body=obj.get("Body"), base64_body=obj.get("Base64Body")
+                )
+                expected_etag = lambda obj=obj, object_target=object_target: transfer.expected_etag(
+                    object_target, body=obj.get("Body"), base64_body=obj.get("Base64Body")
+                )
+
+            yield write_task(object_target["Key"], write, unchanged.get(object_target["Key"]), expected_etag)
+
+        return
+
+    source = properties["Source"]
+    prefix = source.get("Prefix", "")
+
+    for item in source_objects(client, source):
+        object_source = {"Bucket": source["Bucket"], "Key": item["Key"]}
+        object_target = dict(extra_args, Bucket=target["Bucket"], Key=target_key(target, item["Key"][len(prefix):]))
+
+        # The listing already has the size, so there's no need to look it up before copying
+        write = lambda object_source=object_source, object_target=object_target, size=item["Size"]: transfer.copy_object(
+            client, object_source, object_target, size=size
+        )
+
+        yield write_task(object_target["Key"], write, unchanged.get(object_target["Key"]), lambda item=item: item["ETag"])
+
+
+def source_objects(client, source):
+    """
+    Yield the Key and Size of each object under the source prefix
+    """
+
+    paginator = client.get_paginator("list_objects_v2")
+
+    for page in paginator.paginate(Bucket=source["Bucket"], Prefix=source.get("Prefix", "")):
+        for item in page.get("Contents", []):
+            # Skip the placeholder objects the console creates for folders
+            if not item["Key"].endswith("/"):
+                yield item
+
+
+def object_set_keys(client, target, properties):
+    """
+    The keys the set writes to in the target bucket
+    """
+
+    if "Objects" in properties:
+        return [target_key(target, obj["Key"]) for obj in properties["Objects"]]
+
+    # A set copied from a source prefix owns its target prefix. The source may have
+    # changed since the objects were copied, so the keys are listed from the target.
+    # Without a prefix that would be the whole bucket, so nothing is claimed. Such a
+    # set can't be created, but CloudFormation still deletes it after a failed create.
+    if not target.get("Prefix"):
+        return []
+
+    return list(target_etags(client, target))
+
+
+def check_target(target, properties):
+    """
+    Raise an exception if the keys of the set can't be found again to delete them
+    """
+
+    if "Source" in properties and not target.get("Prefix"):
+        raise Exception("A set copied from a Source needs a Target Prefix of its own")
+
+
+def unchanged_objects(client, target, properties, old_properties):
+    """
+    The current ETag, by key, of the objects in the set whose settings are the
+    same in the old properties, so only their content needs to be compared
+    """
+
+    old_target = old_properties.get("Target", {})
+
+    if any(old_target.get(key) != target.get(key) for key in ["Bucket", "ACL"] + pipeline.PIPELINE_SETTINGS):
+        return {}
+
+    etags = target_etags(client, target)
+
+    if "Source" in properties:
+        return etags
+
+    old_settings = {
+        target_key(old_target, obj["Key"]): object_settings(obj)
+        for obj in old_properties.get("Objects", [])
+    }
+
+    return {
+        target_key(target, obj["Key"]): etags[target_key(target, obj["Key"])]
+        for obj in properties["Objects"]
+        if target_key(target, obj["Key"]) in etags
+        and old_settings.get(target_key(target, obj["Key"])) == object_settings(obj)
+    }
+
+
+def put_object_set(client, target, properties, old_properties=None):
+    """
+    Write every object in the set, several at once. On an update, objects
+    that already have the same content and settings are skipped.
+    Returns a list of (key, whether it was written).
+    """
+
+    unchanged = unchanged_objects(client, target, properties, old_properties) if old_properties else {}
+
+    return transfer.run_bounded(object_tasks(client, target, properties, unchanged))
+
+
+def delete_keys(client, bucket, keys):
+    """
+    Delete keys from a bucket in batches of up to 1,000, several batches at once
+    """
+
+    def delete_batch(batch):
+        response = client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+        )
+
+        # Objects that fail to delete are reported in the response rather than raised
+        errors = [error for error in response.get("Errors", []) if error.get("Code") != "NoSuchKey"]
+
+        if errors:
+            raise Exception(f"{errors[0]['Key']}: {errors[0].get('Message', errors[0].get('Code'))}")
+
+        return len(batch)
+
+    tasks = (
+        lambda batch=keys[start:start + DELETE_BATCH_SIZE]: with_retries(f"s3://{bucket}/{batch[0]}", lambda: delete_batch(batch))
+        for start in range(0, len(keys), DELETE_BATCH_SIZE)
+    )
+
+    return sum(transfer.run_bounded(tasks))
@@ -0,0 +1,185 @@
+# Copyright 2018-2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+# Optional processing of a body before it is uploaded. Targets can ask for the
+# ContentType to be inferred from the key and for compressible bodies to be
+# gzip or brotli encoded, one part at a time as they are uploaded.
+
+import mimetypes
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Settings in a target that are handled here rather than passed on to S3
+PIPELINE_SETTINGS = ["InferContentType", "Compress"]
+
+# The encodings that can be used for Compress
+ENCODINGS = ["gzip", "br"]
+
+# Bodies smaller than this many bytes aren't worth compressing
+COMPRESS_THRESHOLD = int(os.environ.get("COMPRESS_THRESHOLD", 1024))
+
+# The bodies are compressed once when they are uploaded, so use the smallest output
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+# Types that Python's built-in table doesn't know, or knows by an older name.
+# The built-in table is used rather than the system's so the result doesn't depend on the host.
+CONTENT_TYPES = {
+    ".js": "text/javascript",
+    ".mjs": "text/javascript",
+    ".json": "application/json",
+    ".map": "application/json",
+    ".webmanifest": "application/manifest+json",
+    ".wasm": "application/wasm",
+    ".svg": "image/svg+xml",
+    ".webp": "image/webp",
+    ".avif": "image/avif",
+    ".ico": "image/x-icon",
+    ".md": "text/markdown",
+    ".ttf": "font/ttf",
+    ".otf": "font/otf",
+    ".woff": "font/woff",
+    ".woff2": "font/woff2",
+}
+
+# Types that compress well. Images, fonts and archives other than these are already compressed.
+COMPRESSIBLE_TYPES = {
+    "application/javascript",
+    "application/json",
+    "application/wasm",
+    "application/xml",
+    "application/vnd.ms-fontobject",
+    "font/otf",
+    "font/ttf",
+    "image/bmp",
+    "image/x-icon",
+}
+
+builtin_types = mimetypes.MimeTypes()
+
+
+def is_true(value):
+    # Booleans in templates reach the function as strings
+    return str(value).lower() == "true"
+
+
+def infer_content_type(key):
+    """
+    The content type for a key from its extension, or None if it isn't known
+    """
+
+    extension = os.path.splitext(key)[1].lower()
+
+    if extension in CONTENT_TYPES:
+        return CONTENT_TYPES[extension]
+
+    return builtin_types.guess_type(key, strict=False)[0]
+
+
+def is_compressible(content_type):
+    if not content_type:
+        return False
+
+    content_type = content_type.split(";")[0].strip().lower()
+
+    return (
+        content_type.startswith("text/")
+        or content_type.endswith("+json")
+        or content_type.endswith("+xml")
+        or content_type in COMPRESSIBLE_TYPES
+    )
+
+
+def check_encoding(encoding):
+    """
+    Raise an exception if the body can't be compressed with encoding
+    """
+
+    if encoding not in ENCODINGS:
+        raise Exception(f"Compress must be one of: {', '.join(ENCODINGS)}")
+
+    if encoding == "br" and brotli is None:
+        raise Exception("Compress: br needs the brotli package, which isn't installed")
+
+
+def prepare(target, size):
+    """
+    The arguments for S3 for a body of about size bytes written to the target,
+    and the encoding to compress the body with, or None to upload it as it is
+    """
+
+    args = {key: value for key, value in target.items() if key not in PIPELINE_SETTINGS}
+
+    if is_true(target.get("InferContentType")) and "ContentType" not in args:
+        content_type = infer_content_type(args["Key"])
+
+        if content_type:
+            args["ContentType"] = content_type
+
+    encoding = target.get("Compress")
+
+    if not encoding or "ContentEncoding" in args:
+        return args, None
+
+    check_encoding(encoding)
+
+    if size < COMPRESS_THRESHOLD or not is_compressible(args.get("ContentType")):
+        return args, None
+
+    return dict(args, ContentEncoding=encoding), encoding
+
+
+def compressor(encoding):
+    """
+    The (compress, finish) functions of a new compression stream
+    """
+
+    check_encoding(encoding)
+
+    if encoding == "br":
+        stream = brotli.Compressor(quality=BROTLI_QUALITY)
+
+        return stream.process, stream.finish
+
+    # wbits of 31 writes a gzip header. Unlike the gzip module it has no timestamp,
+    # so the same body always compresses to the same bytes and the same ETag.
+    stream = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    return stream.compress, stream.flush
+
+
+def compress_parts(chunks, encoding, part_size):
+    """
+    Yield the compressed bytes of an iterable of chunks, part_size bytes at a time.
+    Only the current chunk and less than a part of output are held in memory.
+    """
+
+    compress, finish = compressor(encoding)
+    buffer = bytearray()
+
+    for chunk in chunks:
+        buffer += compress(chunk)
+
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+
+    buffer += finish()
+
+    for start in range(0, len(buffer), part_size):
+        yield bytes(buffer[start:start + part_size])
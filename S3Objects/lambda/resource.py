@@ -11,46 +11,120 @@
 # ANY KIND, either express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
 
-from urllib.request import build_opener, HTTPHandler, Request
-import base64
+from botocore.config import Config
+import binascii
 import boto3
-import http.client
+import cfnresponse
 import json
+import objectset
+import transfer
 
-s3_client = boto3.client("s3")
+# Parts are uploaded from several threads at once, so allow a connection for each
+s3_client = boto3.client("s3", config=Config(max_pool_connections=transfer.MAX_CONCURRENCY))
 
 
-def sendResponse(event, context, status, message):
-    bucket = event["ResourceProperties"].get("Target", {}).get("Bucket")
-    key = event["ResourceProperties"].get("Target", {}).get("Key")
+def sendResponse(event, context, status, message, data=None):
+    target = event["ResourceProperties"].get("Target", {})
+    bucket = target.get("Bucket")
 
-    body = json.dumps(
-        {
-            "Status": status,
-            "Reason": message,
-            "StackId": event["StackId"],
-            "RequestId": event["RequestId"],
-            "LogicalResourceId": event["LogicalResourceId"],
-            "PhysicalResourceId": f"s3://{bucket}/{key}",
-            "Data": {
-                "Bucket": bucket,
-                "Key": key,
-            },
-        }
-    )
+    # Object sets are identified by the prefix they write under
+    if "Key" in target:
+        key = target["Key"]
+        data = dict(data or {}, Bucket=bucket, Key=key)
+    else:
+        key = target.get("Prefix", "")
+        data = dict(data or {}, Bucket=bucket, Prefix=key)
 
-    request = Request(event["ResponseURL"], data=body.encode("utf-8"))
-    request.add_header("Content-Type", "")
-    request.add_header("Content-Length", len(body))
-    request.get_method = lambda: "PUT"
+    # Keep the physical ID of an existing resource, even if its target moves
+    physical_id = event.get("PhysicalResourceId", f"s3://{bucket}/{key}")
 
-    opener = build_opener(HTTPHandler)
-    response = opener.open(request)
+    cfnresponse.send(event, context, status, data, physical_id, reason=message)
+
+
+def object_settings(target):
+    """
+    The settings of a target, other than where it is
+    """
+
+    return {key: value for key, value in target.items() if key not in ("Bucket", "Key")}
+
+
+def is_unchanged(target, old_target, properties):
+    """
+    Returns True if the object at the target already has the content and settings in properties.
+    Its content is compared by ETag, so nothing needs to be downloaded.
+    """
+
+    if object_settings(target) != object_settings(old_target):
+        return False
+
+    if "Source" in properties:
+        # Objects copied in one request keep the ETag of their source
+        expected_etag = s3_client.head_object(**properties["Source"])["ETag"]
+    else:
+        expected_etag = transfer.expected_etag(target, body=properties.get("Body"), base64_body=properties.get("Base64Body"))
+
+    return transfer.current_etag(s3_client, target) == expected_etag
+
+
+def write_object(target, properties):
+    if "Body" in properties:
+        transfer.put_object(s3_client, target, body=properties["Body"])
+
+    elif "Base64Body" in properties:
+        transfer.put_object(s3_client, target, base64_body=properties["Base64Body"])
+
+    elif "Source" in properties:
+        transfer.copy_object(s3_client, properties["Source"], target)
+
+
+def handle_object_set(event, context):
+    request = event["RequestType"]
+    properties = event["ResourceProperties"]
+
+    if "Target" not in properties or all(prop not in properties for prop in ["Objects", "Source"]):
+        return sendResponse(event, context, "FAILED", "Missing required parameters")
+
+    target = properties["Target"]
+
+    try:
+        if request in ("Create", "Update"):
+            objectset.check_target(target, properties)
+
+            old_properties = event.get("OldResourceProperties")
+            written = objectset.put_object_set(s3_client, target, properties, old_properties)
+            changed = len([key for key, was_written in written if was_written])
+
+            # Remove the objects that are no longer part of the set
+            if request == "Update":
+                old_target = old_properties["Target"]
+                keys = set(key for key, _ in written) if old_target["Bucket"] == target["Bucket"] else set()
+                old_keys = [key for key in objectset.object_set_keys(s3_client, old_target, old_properties) if key not in keys]
+                objectset.delete_keys(s3_client, old_target["Bucket"], old_keys)
+
+            return sendResponse(
+                event, context, "SUCCESS", f"Wrote {changed} of {len(written)} objects", {"Count": len(written)}
+            )
+
+        if request == "Delete":
+            keys = objectset.object_set_keys(s3_client, target, properties)
+            deleted = objectset.delete_keys(s3_client, target["Bucket"], keys)
+
+            return sendResponse(event, context, "SUCCESS", f"Deleted {deleted} objects", {"Count": deleted})
+    except binascii.Error:
+        return sendResponse(event, context, "FAILED", "Malformed Base64Body")
+    except Exception as e:
+        return sendResponse(event, context, "FAILED", str(e))
+
+    return sendResponse(event, context, "FAILED", f"Unexpected: {request}")
 
 
 def handler(event, context):
     print("Received request:", json.dumps(event, indent=4))
 
+    if event["ResourceType"] == "Custom::S3ObjectSet":
+        return handle_object_set(event, context)
+
     request = event["RequestType"]
     properties = event["ResourceProperties"]
 
@@ -61,49 +135,37 @@ def handler(event, context):
 
     target = properties["Target"]
 
-    if request in ("Create", "Update"):
-        if "Body" in properties:
-            target.update(
-                {
-                    "Body": properties["Body"],
-                }
-            )
-
-            s3_client.put_object(**target)
+    try:
+        if request in ("Create", "Update"):
+            unchanged = False
 
-        elif "Base64Body" in properties:
-            try:
-                body = base64.b64decode(properties["Base64Body"])
-            except:
-                return sendResponse(event, context, "FAILED", "Malformed Base64Body")
+            if request == "Update":
+                old_target = event["OldResourceProperties"]["Target"]
+                unchanged = is_unchanged(target, old_target, properties)
 
-            target.update({"Body": body})
+            if not unchanged:
+                write_object(target, properties)
 
-            s3_client.put_object(**target)
+            # The physical ID stays the same when the target moves, so CloudFormation
+            # won't delete the old object and it has to be removed here
+            if request == "Update" and (old_target["Bucket"], old_target["Key"]) != (target["Bucket"], target["Key"]):
+                s3_client.delete_object(
+                    Bucket=old_target["Bucket"],
+                    Key=old_target["Key"],
+                )
 
-        elif "Source" in properties:
-            source = properties["Source"]
+            return sendResponse(event, context, "SUCCESS", "Unchanged" if unchanged else "Created")
 
-            s3_client.copy_object(
-                CopySource=source,
+        if request == "Delete":
+            s3_client.delete_object(
                 Bucket=target["Bucket"],
                 Key=target["Key"],
-                MetadataDirective="COPY",
-                TaggingDirective="COPY",
-                ACL=target["ACL"],
             )
 
-        else:
-            return sendResponse(event, context, "FAILED", "Malformed body")
-
-        return sendResponse(event, context, "SUCCESS", "Created")
-
-    if request == "Delete":
-        s3_client.delete_object(
-            Bucket=target["Bucket"],
-            Key=target["Key"],
-        )
-
-        return sendResponse(event, context, "SUCCESS", "Deleted")
+            return sendResponse(event, context, "SUCCESS", "Deleted")
+    except binascii.Error:
+        return sendResponse(event, context, "FAILED", "Malformed Base64Body")
+    except Exception as e:
+        return sendResponse(event, context, "FAILED", str(e))
 
     return sendResponse(event, context, "FAILED", f"Unexpected: {request}")
@@ -0,0 +1,329 @@
+# Copyright 2018-2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+import base64
+import hashlib
+import itertools
+import os
+import pipeline
+import re
+import threading
+
+MB = 1024 * 1024
+
+# Bodies of at least this many bytes are uploaded in parts
+MULTIPART_THRESHOLD = int(os.environ.get("MULTIPART_THRESHOLD", 16 * MB))
+
+# The size of each part of an upload. S3 requires every part but the last to be at least 5 MB.
+PART_SIZE = int(os.environ.get("PART_SIZE", 8 * MB))
+
+# The most parts uploaded or copied at once, which also bounds how many parts are held in memory
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", 8))
+
+# copy_object can't copy objects larger than this, so they are copied in parts instead
+MAX_COPY_OBJECT_SIZE = 5 * 1024 * MB
+
+# The size of each part of a multipart copy
+COPY_PART_SIZE = int(os.environ.get("COPY_PART_SIZE", 512 * MB))
+
+# S3 allows at most this many parts in a multipart upload
+MAX_PARTS = 10000
+
+# Object settings that are kept when an object is copied in parts
+COPIED_HEADERS = [
+    "CacheControl",
+    "ContentDisposition",
+    "ContentEncoding",
+    "ContentLanguage",
+    "ContentType",
+    "Expires",
+    "Metadata",
+    "WebsiteRedirectLocation",
+]
+
+
+def body_parts(body, part_size=PART_SIZE):
+    """
+    Yield the UTF-8 encoding of body a part at a time.
+    Every character is at least one byte, so every part but the last is at least part_size bytes.
+    """
+
+    for start in range(0, len(body), part_size):
+        yield body[start:start + part_size].encode("utf-8")
+
+
+def base64_parts(body, part_size=PART_SIZE):
+    """
+    Yield the decoded bytes of a base64 encoded body a part at a time.
+    Raises binascii.Error if the body is malformed.
+    """
+
+    # Every 4 characters decode to 3 bytes, which only holds if there is no whitespace
+    if re.search(r"\s", body):
+        body = re.sub(r"\s+", "", body)
+
+    chunk_size = part_size // 3 * 4
+
+    for start in range(0, len(body), chunk_size):
+        yield base64.b64decode(body[start:start + chunk_size])
+
+
+def run_bounded(tasks, max_concurrency=MAX_CONCURRENCY):
+    """
+    Run the callables from the tasks iterable on a thread pool, with at most
+    max_concurrency running or waiting at once. Tasks are only taken from the
+    iterable when there is room for them, so a generator of tasks is never read
+    far ahead of the uploads. Returns the results in order, or raises the first error.
+    """
+
+    slots = threading.BoundedSemaphore(max_concurrency)
+    errors = []
+    futures = []
+
+    def done(future):
+        if future.exception() is not None:
+            errors.append(future.exception())
+
+        slots.release()
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        for task in tasks:
+            slots.acquire()
+
+            # Stop taking new tasks once one has failed
+            if errors:
+                slots.release()
+                break
+
+            future = executor.submit(task)
+            future.add_done_callback(done)
+            futures.append(future)
+
+    if errors:
+        raise errors[0]
+
+    return [future.result() for future in futures]
+
+
+def run_multipart(client, create_args, make_tasks, max_concurrency=MAX_CONCURRENCY):
+    """
+    Create a multipart upload with create_args, run the tasks returned by
+    make_tasks(location) to add its parts and complete it.
+    Each task returns the {"ETag", "PartNumber"} of its part.
+    The upload is aborted if any part fails.
+    """
+
+    upload_id = client.create_multipart_upload(**create_args)["UploadId"]
+
+    location = {
+        "Bucket": create_args["Bucket"],
+        "Key": create_args["Key"],
+        "UploadId": upload_id,
+    }
+
+    try:
+        parts = run_bounded(make_tasks(location), max_concurrency)
+
+        return client.complete_multipart_upload(MultipartUpload={"Parts": parts}, **location)
+    except BaseException:
+        client.abort_multipart_upload(**location)
+        raise
+
+
+def multipart_upload(client, target, parts, max_concurrency=MAX_CONCURRENCY):
+    """
+    Upload an object from an iterable of parts, uploading several parts at once.
+    target holds the arguments for create_multipart_upload (Bucket, Key, ACL, ContentType, ...).
+    """
+
+    def make_tasks(location):
+        def upload_part(part_number, data):
+            response = client.upload_part(Body=data, PartNumber=part_number, **location)
+
+            return {"ETag": response["ETag"], "PartNumber": part_number}
+
+        return (
+            (lambda part_number=part_number, data=data: upload_part(part_number, data))
+            for part_number, data in enumerate(parts, 1)
+        )
+
+    return run_multipart(client, target, make_tasks, max_concurrency)
+
+
+def body_size(body=None, base64_body=None):
+    """
+    The size of a body in bytes, without encoding or decoding it.
+    Every character is at least one byte and every 4 base64 characters are 3 bytes.
+    """
+
+    if body is not None:
+        return len(body)
+
+    return len(base64_body) * 3 // 4
+
+
+def body_content(body=None, base64_body=None, encoding=None):
+    """
+    The content of a string body or a base64 encoded body, as either
+    (bytes, None) for a body small enough to upload in one request or
+    (None, parts) for a body to upload in parts, where parts is a generator.
+    If encoding is given the body is compressed with it.
+    """
+
+    if encoding is None:
+        if body is not None:
+            if len(body) < MULTIPART_THRESHOLD:
+                return body.encode("utf-8"), None
+
+            return None, body_parts(body)
+
+        if body_size(base64_body=base64_body) < MULTIPART_THRESHOLD:
+            return base64.b64decode(base64_body), None
+
+        return None, base64_parts(base64_body)
+
+    chunks = body_parts(body) if body is not None else base64_parts(base64_body)
+    parts = pipeline.compress_parts(chunks, encoding, PART_SIZE)
+
+    # The compressed size isn't known until the body has been compressed, so compress
+    # up to the threshold and only upload in parts if there is more to come
+    head = []
+    size = 0
+
+    for part in parts:
+        head.append(part)
+        size += len(part)
+
+        if size >= MULTIPART_THRESHOLD:
+            return None, itertools.chain(head, parts)
+
+    return b"".join(head), None
+
+
+def put_object(client, target, body=None, base64_body=None):
+    """
+    Create an object from a string body or a base64 encoded body.
+    Small bodies are uploaded with put_object, larger ones in parts so that
+    the whole object is never held in memory.
+    """
+
+    args, encoding = pipeline.prepare(target, body_size(body, base64_body))
+    data, parts = body_content(body, base64_body, encoding)
+
+    if parts is None:
+        return client.put_object(Body=data, **args)
+
+    return multipart_upload(client, args, parts)
+
+
+def expected_etag(target, body=None, base64_body=None):
+    """
+    The ETag S3 will give the object put_object creates from a body, without uploading it.
+    That is the MD5 of the object, or for a multipart upload the MD5 of the MD5s of
+    its parts followed by the number of parts. Objects encrypted with KMS have
+    other ETags, so they never match and are always written.
+    """
+
+    _, encoding = pipeline.prepare(target, body_size(body, base64_body))
+    data, parts = body_content(body, base64_body, encoding)
+
+    if parts is None:
+        return '"{}"'.format(hashlib.md5(data).hexdigest())
+
+    digests = [hashlib.md5(part).digest() for part in parts]
+
+    return '"{}-{}"'.format(hashlib.md5(b"".join(digests)).hexdigest(), len(digests))
+
+
+def current_etag(client, target):
+    """
+    The ETag of the object at the target, or None if there isn't one
+    """
+
+    try:
+        return client.head_object(Bucket=target["Bucket"], Key=target["Key"])["ETag"]
+    except ClientError:
+        return None
+
+
+def copy_tagging(client, source):
+    """
+    The tags of the source object, encoded for create_multipart_upload
+    """
+
+    tags = client.get_object_tagging(**source)["TagSet"]
+
+    return urlencode([(tag["Key"], tag["Value"]) for tag in tags])
+
+
+def copy_object(client, source, target, size=None):
+    """
+    Copy an object, keeping its metadata and tags.
+    source holds Bucket, Key and optionally VersionId. target holds Bucket, Key and optionally ACL.
+    Objects larger than copy_object allows are copied in byte ranges, several at once.
+    If the size of the source is already known, small objects are copied without looking it up.
+    """
+
+    extra_args = {"ACL": target["ACL"]} if "ACL" in target else {}
+
+    if size is None or size > MAX_COPY_OBJECT_SIZE:
+        head = client.head_object(**source)
+        size = head["ContentLength"]
+
+    if size <= MAX_COPY_OBJECT_SIZE:
+        return client.copy_object(
+            CopySource=source,
+            Bucket=target["Bucket"],
+            Key=target["Key"],
+            MetadataDirective="COPY",
+            TaggingDirective="COPY",
+            **extra_args,
+        )
+
+    extra_args.update({key: head[key] for key in COPIED_HEADERS if key in head})
+
+    tagging = copy_tagging(client, source)
+
+    if tagging:
+        extra_args["Tagging"] = tagging
+
+    part_size = max(COPY_PART_SIZE, -(-size // MAX_PARTS))
+
+    def make_tasks(location):
+        def copy_part(part_number, start):
+            end = min(start + part_size, size) - 1
+
+            response = client.upload_part_copy(
+                CopySource=source,
+                CopySourceRange=f"bytes={start}-{end}",
+                # Fail rather than mix parts of different objects if the source changes during the copy
+                CopySourceIfMatch=head["ETag"],
+                PartNumber=part_number,
+                **location,
+            )
+
+            return {"ETag": response["CopyPartResult"]["ETag"], "PartNumber": part_number}
+
+        return (
+            (lambda part_number=part_number, start=start: copy_part(part_number, start))
+            for part_number, start in enumerate(range(0, size, part_size), 1)
+        )
+
+    return run_multipart(
+        client,
+        dict(extra_args, Bucket=target["Bucket"], Key=target["Key"]),
+        make_tasks,
+    )
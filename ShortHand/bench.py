@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the ShortHand macro on 10,000 shorthand resources:
+
+    python bench.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "lambda"))
+
+import convert
+import resolve
+
+ENTRIES = 10000
+
+# A mix of full, partial and bare type names as they appear in templates
+SHORTHAND_TYPES = [
+    "AWS::S3::Bucket",
+    "S3::Bucket",
+    "Bucket",
+    "SQS::Queue",
+    "EC2::Instance",
+    "Lambda::Function",
+    "DynamoDB::Table",
+    "SNS::Topic",
+    "IAM::Role",
+    "ApiGateway::RestApi",
+]
+
+def best(function, repeat=5):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+def linear_scan(types, name):
+    """
+    The resolver the suffix index replaced: every type name is checked for every lookup
+    """
+
+    return [key for key in types if key.endswith(name)]
+
+def bench_resolve():
+    types, _ = resolve.suffix_index()
+    names = [SHORTHAND_TYPES[i % len(SHORTHAND_TYPES)] for i in range(ENTRIES)]
+
+    scan = best(lambda: [linear_scan(types, name) for name in names])
+    index = best(lambda: [resolve.resource.__wrapped__(name) for name in names])
+    memoized = best(lambda: [resolve.resource(name) for name in names])
+
+    print("Resolving {:,} shorthand types against {:,} resource types".format(ENTRIES, len(types)))
+    print("  linear scan          {:.3f}s".format(scan))
+    print("  suffix index         {:.3f}s".format(index))
+    print("  memoized             {:.3f}s".format(memoized))
+
+def split_parse_name(name):
+    """
+    The parser the tokenizer replaced, which split the name and rebuilt the
+    properties through an intermediate dict. It can't handle quoted values or
+    escaped dots, and nests shared prefixes such as A.B.x and A.B.y incorrectly.
+    """
+
+    parts = name.split()
+    ident = [part for part in parts if "=" not in part]
+    rolled = {key: value for key, value in [part.split("=") for part in parts if "=" in part]}
+    props = {}
+
+    for key, value in rolled.items():
+        key_parts = key.split(".")
+        current = props
+
+        for part in key_parts[:-1]:
+            if part not in current:
+                current[part] = {}
+                current = current[part]
+
+        current[key_parts[-1]] = convert.handle_value(value)
+
+    return ident, props
+
+def bench_parse():
+    plain = [
+        "Queue{0} SQS::Queue QueueName=queue-{0} VisibilityTimeout=30 RedrivePolicy.maxReceiveCount=5".format(i)
+        for i in range(ENTRIES)
+    ]
+    quoted = [
+        "Method{0} ApiGateway::Method HttpMethod=GET OperationName='list items {0}' "
+        "RequestParameters.method\\.request\\.querystring\\.page=true".format(i)
+        for i in range(ENTRIES)
+    ]
+
+    split = best(lambda: [split_parse_name(name) for name in plain])
+    tokenized = best(lambda: [convert.parse_name(name) for name in plain])
+    tokenized_quoted = best(lambda: [convert.parse_name(name) for name in quoted])
+    template = best(lambda: convert.convert_template({"Resources": list(plain)}))
+
+    print("Parsing {:,} shorthand names".format(ENTRIES))
+    print("  split and rebuild           {:.3f}s".format(split))
+    print("  tokenizer                   {:.3f}s".format(tokenized))
+    print("  tokenizer, quoted/escaped   {:.3f}s".format(tokenized_quoted))
+    print("Converting a template of {:,} shorthand resources {:.3f}s".format(ENTRIES, template))
+
+if __name__ == "__main__":
+    bench_resolve()
+    bench_parse()
@@ -15,86 +15,244 @@
 Convert an object from our custom format into something more explicit
 """
 
+import hashlib
+import json
 import resolve
 import re
+import validate
 
 SUB_RE = re.compile(r"\$\{(?!!)")
 
+# How names are generated for resources that don't have one
+NAMING_MODES = ("Counter", "Hash")
+
 def handle_value(value):
-    if SUB_RE.match(value):
+    if isinstance(value, str) and SUB_RE.match(value):
         return {
             "Fn::Sub": value,
         }
 
     return value
 
-def unroll_props(rolled):
-    props = {}
+# A single word of the shorthand syntax: either part of the resource's name
+# and type, or a property assignment. Values may be quoted to include spaces.
+TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<key>(?:[^\s="'\\]|\\.)+)
+        (?:=(?:
+            "(?P<dquoted>(?:[^"\\]|\\.)*)"
+            |'(?P<squoted>(?:[^'\\]|\\.)*)'
+            |(?P<value>(?!["'])\S*)
+        ))?
+    )(?=\s|$)
+""", re.VERBOSE)
 
-    for key, value in rolled.items():
-        key_parts = key.split(".")
+# The parts of a dotted property path, where a dot may be escaped with a backslash
+PATH_PART_RE = re.compile(r"(?:[^.\\]|\\.)+")
 
-        current = props
+ESCAPE_RE = re.compile(r"\\(.)")
+
+def split_path(key):
+    if "\\" not in key:
+        return key.split(".")
+
+    return [
+        ESCAPE_RE.sub(r"\1", part)
+        for part in PATH_PART_RE.findall(key)
+    ]
 
-        for part in key_parts[:-1]:
-            if part not in current:
-                current[part] = {}
-                current = current[part]
+def set_path(props, path, value, sub=True):
+    current = props
 
-        current[key_parts[-1]] = handle_value(value)
+    for part in path[:-1]:
+        current = current.setdefault(part, {})
+
+        if not isinstance(current, dict):
+            raise Exception("Conflicting values for property: {}".format(".".join(path)))
+
+    current[path[-1]] = handle_value(value) if sub else value
+
+def unroll_props(rolled, props=None, sub=True):
+    if props is None:
+        props = {}
+
+    for key, value in rolled.items():
+        set_path(props, split_path(key), value, sub)
 
     return props
 
-def parse_name(name):
-    parts = name.split()
+def tokenize(name):
+    """
+    Yields (key, value) for each word of the shorthand syntax, where value
+    is None for the words making up the resource's name and type
+    """
 
-    ident = [
-        part
-        for part in parts
-        if "=" not in part
-    ]
+    # Most names have no quoting or escaping, so a plain split will do
+    if '"' not in name and "'" not in name and "\\" not in name:
+        for part in name.split():
+            key, sep, value = part.partition("=")
+            yield key, value if sep else None
 
-    props = unroll_props({
-        key: value
-        for key, value in [
-            part.split("=")
-            for part
-            in parts if "=" in part
-        ]
-    })
+        return
+
+    pos = 0
+    end = len(name.rstrip())
+
+    while pos < end:
+        match = TOKEN_RE.match(name, pos)
+
+        if not match:
+            raise Exception("Bad format at: {}".format(name[pos:]))
+
+        pos = match.end()
+        key, dquoted, squoted, value = match.group("key", "dquoted", "squoted", "value")
+
+        if dquoted is not None:
+            value = ESCAPE_RE.sub(r"\1", dquoted)
+        elif squoted is not None:
+            value = ESCAPE_RE.sub(r"\1", squoted)
+
+        yield key, value
+
+def parse_name(name, sub=True):
+    ident = []
+    props = {}
+
+    for key, value in tokenize(name):
+        if value is None:
+            ident.append(key)
+        else:
+            set_path(props, split_path(key), value, sub)
 
     return ident, props
 
-def convert(value):
+def convert(value, sub=True):
+    """
+    Yields (ident, props) for each entry of a section in the shorthand syntax.
+    Unless `sub` is False, string values containing ${} are wrapped in Fn::Sub.
+    """
+
     if isinstance(value, str):
-        yield parse_name(value)
+        yield parse_name(value, sub)
     elif isinstance(value, dict):
         for k, v in value.items():
-            ident, props = parse_name(k)
-            props.update(unroll_props(v))
-            yield ident, props
+            ident, props = parse_name(k, sub)
+            yield ident, unroll_props(v, props, sub)
     elif isinstance(value, list):
         for v in value:
-            for ident, props in convert(v):
+            for ident, props in convert(v, sub):
                 yield ident, props
     else:
         raise Exception("Bad format at: {}".format(value))
 
-def convert_template(template):
+def digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()[:8].upper()
+
+def identity_digest(resource):
+    """
+    A digest of the resource's type and the properties that can't be changed without replacing it
+    """
+
+    return digest({
+        "Type": resource["Type"],
+        "Properties": {
+            key: resource["Properties"][key]
+            for key in resolve.immutable_properties(resource["Type"])
+            if key in resource["Properties"]
+        },
+    })
+
+def auto_name(resource, reserved, counts, naming, shared=frozenset()):
+    """
+    Generate a name for an un-named resource that isn't already in `reserved`
+
+    With "Counter" naming, resources are numbered in order per type, e.g. Bucket1, Bucket2.
+    With "Hash" naming, the name is derived from the resource's type and the properties
+    that can't be changed without replacing it, so that it doesn't change when other
+    resources are added or removed around it, or when its other properties are edited.
+    Un-named resources whose identity digest is in `shared` can't be told apart that way,
+    so their whole content is hashed instead.
+    """
+
+    base = resource["Type"].split("::")[-1]
+
+    if naming == "Hash":
+        key = identity_digest(resource)
+
+        if key in shared:
+            key = digest(resource)
+
+        name = base + key
+
+        if name in reserved:
+            raise Exception("Can't name identical {} resources apart, give them explicit names".format(resource["Type"]))
+
+        reserved.add(name)
+
+        return name
+
+    # Counters only ever move forward, so each number is tried at most once per type
+    count = counts.get(base, 0) + 1
+    name = base + str(count)
+
+    while name in reserved:
+        count += 1
+        name = base + str(count)
+
+    counts[base] = count
+    reserved.add(name)
+
+    return name
+
+# Converters for each top-level section of a template, keyed by section name.
+# Each is called with the section's value and a dict of options, and returns
+# the section in standard CloudFormation syntax.
+SECTION_CONVERTERS = {}
+
+def section(name):
+    """
+    Register a function as the converter for a template section
+    """
+
+    def register(converter):
+        SECTION_CONVERTERS[name] = converter
+        return converter
+
+    return register
+
+@section("Resources")
+def convert_resources(value, options):
     resources = {}
     counts = {}
+    errors = []
+    warnings = []
 
-    for ident, props in convert(template.get("Resources", [])):
-        resource = {}
+    # Collect the explicit names first so that generated names can never clash with them
+    entries = []
+    reserved = set()
 
+    for ident, props in convert(value):
         if len(ident) == 1:
             name = None
-            resource["Type"] = ident[0]
+            resource_type = ident[0]
         else:
             name = ident[0]
-            resource["Type"] = ident[1]
+            resource_type = ident[1]
+
+            if name in reserved:
+                raise Exception("Duplicate resource name: {}".format(name))
+
+            reserved.add(name)
+
+        entries.append((name, resource_type, props))
 
-        resource["Properties"] = props
+    typed = []
+
+    for name, resource_type, props in entries:
+        resource = {
+            "Type": resource_type,
+            "Properties": props,
+        }
 
         types = resolve.resource(resource["Type"])
 
@@ -102,22 +260,131 @@ def convert_template(template):
             raise Exception("Ambiguous or unknown resource type: {}".format(resource["Type"]))
 
         resource["Type"] = types[0]
+        typed.append((name, resource))
+
+    # With Hash naming, find the un-named resources that only their other properties tell apart
+    shared = set()
+
+    if options["naming"] == "Hash":
+        seen = set()
+
+        for name, resource in typed:
+            if not name:
+                key = identity_digest(resource)
+                (shared if key in seen else seen).add(key)
 
+    for name, resource in typed:
         # Handle un-named resources
         if not name:
-            name = resource["Type"].split("::")[-1]
-            if resource["Type"] not in counts:
-                counts[resource["Type"]] = 1
-            else:
-                counts[resource["Type"]] += 1
+            name = auto_name(resource, reserved, counts, options["naming"], shared)
 
-            while "{}{}".format(name, counts[resource["Type"]]) in resources:
-                counts[resource["Type"]] += 1
+        resources[name] = resource
 
-            name = "{}{}".format(name, counts[resource["Type"]])
+        # Validation loads the full resource specification, so it only runs when asked for
+        if options["validation"]:
+            errors.extend(validate.validate_properties(resource["Properties"], resource["Type"], name, warnings))
 
-        resources[name] = resource
+    for warning in warnings:
+        print("Warning: {}".format(warning))
+
+    if errors:
+        raise Exception("Invalid properties:\n{}".format("\n".join(errors)))
+
+    return resources
+
+@section("Parameters")
+def convert_parameters(value, options):
+    """
+    "Name [Type] Prop=Value..." where Type defaults to String
+    """
+
+    # Only a list is in the shorthand syntax, a map is already standard CloudFormation
+    if not isinstance(value, list):
+        return value
+
+    parameters = {}
+
+    for ident, props in convert(value, sub=False):
+        if len(ident) not in (1, 2):
+            raise Exception("Bad parameter: {}".format(" ".join(ident)))
+
+        parameters[ident[0]] = dict({"Type": ident[1] if len(ident) == 2 else "String"}, **props)
+
+    return parameters
+
+@section("Outputs")
+def convert_outputs(value, options):
+    """
+    "Name [Value] Prop=Value..." where Value can also be given as a property
+    """
+
+    if not isinstance(value, list):
+        return value
+
+    outputs = {}
+
+    for ident, props in convert(value):
+        if len(ident) == 2:
+            props = dict({"Value": handle_value(ident[1])}, **props)
+        elif len(ident) != 1:
+            raise Exception("Bad output: {}".format(" ".join(ident)))
+
+        if "Value" not in props:
+            raise Exception("Output {} has no Value".format(ident[0]))
+
+        outputs[ident[0]] = props
+
+    return outputs
+
+@section("Conditions")
+def convert_conditions(value, options):
+    """
+    "Name Parameter=Value..." is true when every parameter has the given value
+    """
+
+    if not isinstance(value, list):
+        return value
+
+    conditions = {}
+
+    for ident, props in convert(value, sub=False):
+        if len(ident) != 1:
+            raise Exception("Bad condition: {}".format(" ".join(ident)))
+
+        # An intrinsic function such as Fn::Equals is passed through as it is
+        if validate.is_intrinsic(props) or list(props) == ["Condition"]:
+            conditions[ident[0]] = props
+            continue
+
+        if not props or any(isinstance(v, dict) for v in props.values()):
+            raise Exception("Bad condition: {}".format(ident[0]))
+
+        equals = [
+            {"Fn::Equals": [{"Ref": parameter}, expected]}
+            for parameter, expected in props.items()
+        ]
+
+        conditions[ident[0]] = equals[0] if len(equals) == 1 else {"Fn::And": equals}
+
+    return conditions
+
+def convert_template(template, naming="Counter", validation=False):
+    if naming not in NAMING_MODES:
+        raise Exception("Unknown naming mode: {}".format(naming))
+
+    options = {
+        "naming": naming,
+        "validation": validation,
+    }
+
+    if "Resources" not in template:
+        template["Resources"] = []
+
+    # Convert every section that has a converter in a single pass over the template
+    for key, value in template.items():
+        converter = SECTION_CONVERTERS.get(key)
 
-    template["Resources"] = resources
+        if converter:
+            template[key] = converter(value, options)
 
     return template
@@ -14,8 +14,24 @@
 from convert import convert_template
 
 def handler(event, context):
+    try:
+        params = event.get("params") or {}
+        naming = params.get("Naming", "Counter")
+        # Transform parameters may arrive as strings
+        validation = str(params.get("Validate", False)).lower() == "true"
+        fragment = convert_template(event["fragment"], naming, validation)
+    except Exception as e:
+        print(e)
+
+        return {
+            "requestId": event["requestId"],
+            "status": "failure",
+            "fragment": event["fragment"],
+            "errorMessage": str(e),
+        }
+
     return {
         "requestId": event["requestId"],
         "status": "success",
-        "fragment": convert_template(event["fragment"]),
+        "fragment": fragment,
     }
@@ -11,17 +11,114 @@
 # ANY KIND, either express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
 
+from functools import lru_cache
 import json
+import os
 
-SPEC = json.load(open("spec.json"))
+HERE = os.path.dirname(os.path.abspath(__file__))
 
+# The full CloudFormation resource specification
+SPEC_FILE = os.path.join(HERE, "spec.json")
+
+# A compact artifact built from the spec by running this file, holding only
+# the resource type names and their suffix index
+INDEX_FILE = os.path.join(HERE, "types.json")
+
+@lru_cache(maxsize=None)
+def load_spec():
+    """
+    Returns the full resource specification, loading it on first use
+    """
+
+    with open(SPEC_FILE) as f:
+        return json.load(f)
+
+def build_suffix_index(types):
+    """
+    Map every suffix of every resource type name to the positions in `types`
+    of the types that end with it
+    E.g. "Bucket", "::Bucket" and "S3::Bucket" all map to AWS::S3::Bucket
+    """
+
+    index = {}
+
+    for position, key in enumerate(types):
+        for start in range(len(key)):
+            index.setdefault(key[start:], []).append(position)
+
+    return index
+
+def build_immutable_properties(spec):
+    """
+    Map each resource type name to the sorted names of its properties that
+    can't be changed without replacing the resource
+    """
+
+    return {
+        key: sorted(
+            name for name, prop in definition.get("Properties", {}).items()
+            if prop.get("UpdateType") == "Immutable"
+        )
+        for key, definition in spec["ResourceTypes"].items()
+    }
+
+def build_artifact():
+    """
+    Build the compact artifact from the full spec
+    """
+
+    spec = load_spec()
+    types = sorted(spec["ResourceTypes"].keys())
+
+    return {
+        "ResourceSpecificationVersion": spec.get("ResourceSpecificationVersion"),
+        "ResourceTypes": types,
+        "SuffixIndex": build_suffix_index(types),
+        "ImmutableProperties": build_immutable_properties(spec),
+    }
+
+@lru_cache(maxsize=None)
+def load_artifact():
+    """
+    Returns the compact artifact, loading it on first use and falling back
+    to building it from the full spec
+    """
+
+    try:
+        with open(INDEX_FILE) as f:
+            return json.load(f)
+    except IOError:
+        return build_artifact()
+
+def suffix_index():
+    """
+    Returns the resource type names and their suffix index
+    """
+
+    artifact = load_artifact()
+
+    return artifact["ResourceTypes"], artifact["SuffixIndex"]
+
+def immutable_properties(type_name):
+    """
+    Returns the names of the properties of a resource type that can't be
+    changed without replacing the resource
+    """
+
+    return load_artifact()["ImmutableProperties"].get(type_name, [])
+
+@lru_cache(maxsize=None)
 def resource(name):
     """
     Returns resource types that match `name`, working right-to-left
     E.g. S3::Bucket will match AWS::S3::Bucket
     """
 
-    return [
-        key for key in SPEC["ResourceTypes"].keys()
-        if key.endswith(name)
-    ]
+    types, index = suffix_index()
+
+    return tuple(types[position] for position in index.get(name, ()))
+
+if __name__ == "__main__":
+    # Regenerate types.json after updating spec.json
+    with open(INDEX_FILE, "w") as f:
+        json.dump(build_artifact(), f, separators=(",", ":"), sort_keys=True)
@@ -0,0 +1,209 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+"""
+Check resource properties against the CloudFormation resource specification
+"""
+
+from collections import namedtuple
+from difflib import get_close_matches
+from functools import lru_cache
+
+import resolve
+
+Property = namedtuple("Property", [
+    "required",
+    "primitive_type",
+    "type",
+    "primitive_item_type",
+    "item_type",
+])
+
+def is_intrinsic(value):
+    """
+    Returns True if `value` is an intrinsic function such as Ref or Fn::Sub,
+    whose result can't be checked until the stack is deployed
+    """
+
+    if not isinstance(value, dict) or len(value) != 1:
+        return False
+
+    key = next(iter(value))
+
+    return key == "Ref" or key.startswith("Fn::")
+
+@lru_cache(maxsize=None)
+def schema(name):
+    """
+    Returns the properties of a resource type or property type, keyed by name.
+    Schemas are compiled on first use and cached across invocations.
+    """
+
+    spec = resolve.load_spec()
+    definition = spec["ResourceTypes"].get(name) or spec["PropertyTypes"].get(name)
+
+    if definition is None:
+        return None
+
+    # Property types are named after the resource type they belong to
+    prefix = name.split(".")[0]
+
+    def property_type(type_name):
+        if type_name is None:
+            return None
+
+        qualified = "{}.{}".format(prefix, type_name)
+
+        if qualified in spec["PropertyTypes"]:
+            return qualified
+
+        return type_name
+
+    return {
+        key: Property(
+            required=prop.get("Required", False),
+            primitive_type=prop.get("PrimitiveType"),
+            type=prop.get("Type") if prop.get("Type") in ("List", "Map") else property_type(prop.get("Type")),
+            primitive_item_type=prop.get("PrimitiveItemType"),
+            item_type=property_type(prop.get("ItemType")),
+        )
+        for key, prop in definition.get("Properties", {}).items()
+    }
+
+def coerce_primitive(value, primitive_type, path):
+    """
+    Convert a value from the shorthand syntax to its primitive type.
+    Returns the converted value and a list of errors.
+    """
+
+    if isinstance(value, str):
+        try:
+            if primitive_type in ("Integer", "Long"):
+                return int(value), []
+
+            if primitive_type == "Double":
+                return float(value), []
+        except ValueError:
+            return value, ["{}: expected {} but got '{}'".format(path, primitive_type, value)]
+
+        if primitive_type == "Boolean":
+            if value.lower() in ("true", "false"):
+                return value.lower() == "true", []
+
+            return value, ["{}: expected Boolean but got '{}'".format(path, value)]
+
+        return value, []
+
+    if primitive_type in ("Integer", "Long", "Double") and (isinstance(value, bool) or not isinstance(value, (int, float))):
+        return value, ["{}: expected {} but got {}".format(path, primitive_type, type(value).__name__)]
+
+    if primitive_type == "Boolean" and not isinstance(value, bool):
+        return value, ["{}: expected Boolean but got {}".format(path, type(value).__name__)]
+
+    return value, []
+
+def check_value(value, primitive_type, value_type, path, warnings):
+    """
+    Check a single value, returning the (possibly converted) value and a list of errors
+    """
+
+    if is_intrinsic(value):
+        return value, []
+
+    if primitive_type is not None:
+        return coerce_primitive(value, primitive_type, path)
+
+    if value_type is None:
+        return value, []
+
+    if not isinstance(value, dict):
+        return value, ["{}: expected an object of type {}".format(path, value_type)]
+
+    return value, validate_properties(value, value_type, path, warnings)
+
+def check_property(value, prop, path, warnings):
+    """
+    Check the value of a property, returning the (possibly converted) value and a list of errors
+    """
+
+    if prop.type == "List":
+        if is_intrinsic(value):
+            return value, []
+
+        if not isinstance(value, list):
+            return value, ["{}: expected a list".format(path)]
+
+        errors = []
+
+        for i, item in enumerate(value):
+            value[i], item_errors = check_value(item, prop.primitive_item_type, prop.item_type, "{}[{}]".format(path, i), warnings)
+            errors.extend(item_errors)
+
+        return value, errors
+
+    if prop.type == "Map":
+        if is_intrinsic(value):
+            return value, []
+
+        if not isinstance(value, dict):
+            return value, ["{}: expected a map".format(path)]
+
+        errors = []
+
+        for key, item in value.items():
+            value[key], item_errors = check_value(item, prop.primitive_item_type, prop.item_type, "{}.{}".format(path, key), warnings)
+            errors.extend(item_errors)
+
+        return value, errors
+
+    return check_value(value, prop.primitive_type, prop.type, path, warnings)
+
+def validate_properties(properties, type_name, path, warnings):
+    """
+    Check `properties` against the schema for `type_name`, converting values
+    to their primitive types in place.
+    Returns a list of errors, which is empty if the properties are valid.
+
+    The bundled specification doesn't know about properties added to
+    CloudFormation since it was published, so unknown properties are only
+    added to `warnings` rather than being treated as errors.
+    """
+
+    properties_schema = schema(type_name)
+
+    if properties_schema is None:
+        return []
+
+    errors = []
+
+    for key, value in properties.items():
+        prop_path = "{}.{}".format(path, key)
+
+        if key not in properties_schema:
+            suggestions = get_close_matches(key, properties_schema.keys(), n=1)
+
+            if suggestions:
+                warnings.append("{}: unknown property for {} (did you mean {}?)".format(prop_path, type_name, suggestions[0]))
+            else:
+                warnings.append("{}: unknown property for {}".format(prop_path, type_name))
+
+            continue
+
+        properties[key], value_errors = check_property(value, properties_schema[key], prop_path, warnings)
+        errors.extend(value_errors)
+
+    for key, prop in properties_schema.items():
+        if prop.required and key not in properties:
+            errors.append("{}: missing required property {}".format(path, key))
+
+    return errors